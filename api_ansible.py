@@ -1,131 +1,1340 @@
 #!/usr/bin/env python
-import os
-import sys
+import multiprocessing
+import threading
+import argparse
+import getpass
+import logging
+import sqlite3
+import signal
+import socket
 import json
-from collections import namedtuple
+import time
+import sys
+import os
+from collections import namedtuple, OrderedDict, deque
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+""" Run ad-hoc tasks on many hosts through the Ansible API
+    Runner keeps the loader, variable manager, inventory and
+    task queue manager between runs, so a long lived process
+    (e.g. a Cockpit integration) can call run() repeatedly.
+    With --serve, jobs are queued and run in the background by
+    a pool of worker processes, see JobService.
+    Ansible itself is only imported by the code that runs tasks,
+    so --help, argument errors and job service clients start fast.
+"""
+
 
-from ansible.parsing.dataloader import DataLoader
-from ansible.vars import VariableManager
-from ansible.inventory import Inventory
-from ansible.executor.playbook_executor import PlaybookExecutor
-from ansible.plugins.callback import CallbackBase
-from ansible.playbook.play import Play
-from ansible.executor.task_queue_manager import TaskQueueManager
+LOG = logging.getLogger(__name__)
 
+CONNECTION_TIMEOUT = 10
 
-class ResultCallback(CallbackBase):
+# password: password login, one SSH connection per task step.
+# performance: key or agent login (password as fallback),
+# connections multiplexed with ControlPersist and modules
+# pipelined over the connection instead of copied with sftp.
+# Pipelining needs sudo without requiretty on the hosts.
+CONNECTION_PROFILES = ('password', 'performance')
+
+# Result fields StreamCallback leaves out by default: facts are
+# large and stdout_lines repeats stdout
+DROP_FIELDS = ('ansible_facts', 'stdout_lines', 'stderr_lines',
+               'invocation')
+
+# Example tasks run when no --command is given
+DEFAULT_TASKS = [
+    dict(action=dict(module='shell', args='uptime')),
+    dict(action=dict(module='shell',
+                     args="""date -d@$(awk '{print $1}' /proc/uptime)"""
+                          """ +'%j %T' | awk '{print $1-1"d",$2}'""")),
+]
+
+Options = namedtuple('Options', ['listtags',
+                                 'listtasks',
+                                 'listhosts',
+                                 'syntax',
+                                 'connection',
+                                 'module_path',
+                                 'forks',
+                                 'remote_user',
+                                 'private_key_file',
+                                 'ssh_common_args',
+                                 'ssh_extra_args',
+                                 'sftp_extra_args',
+                                 'scp_extra_args',
+                                 'become',
+                                 'become_method',
+                                 'become_user',
+                                 'verbosity',
+                                 'check'])
+
+
+# Callback classes bound to Ansible's CallbackBase
+_callback_classes = {}
+
+
+def ansible_callback(callback):
+    """ Make a callback object of this module an instance of
+        Ansible's CallbackBase, as the task queue manager wants.
+        The classes do not derive from it so that defining them
+        does not import Ansible.
+    """
+    from ansible.plugins.callback import CallbackBase
+    if isinstance(callback, CallbackBase):
+        return callback
+
+    cls = type(callback)
+    if cls not in _callback_classes:
+        _callback_classes[cls] = type(cls.__name__, (cls, CallbackBase), {})
+    callback.__class__ = _callback_classes[cls]
+    CallbackBase.__init__(callback)
+    return callback
+
+
+class ResultCallback(object):
 
     def v2_runner_on_ok(self, result, **kwargs):
         host = result._host
-        print json.dumps({host.name: result._result}, indent=4)
+        print(json.dumps({host.name: result._result}, indent=4))
 
     def v2_runner_on_failed(self, result, ignore_errors=False):
         host = result._host
-        delegated_vars = result._result.get('_ansible_delegated_vars', None)
         if 'exception' in result._result:
             error = result._result['exception'].strip().split('\n')[-1]
-            print json.dumps({host.name: error}, indent=4)
+            print(json.dumps({host.name: error}, indent=4))
             del result._result['exception']
 
         if result._task.loop and 'results' in result._result:
             pass
         else:
-            error = "fatal: [%s]: FAILED! => %s" % (result._host.get_name(), result._result)
-            print json.dumps({host.name: error}, indent=4)
+            error = "fatal: [%s]: FAILED! => %s" % (result._host.get_name(),
+                                                    result._result)
+            print(json.dumps({host.name: error}, indent=4))
 
     def v2_runner_on_unreachable(self, result):
         host = result._host
         delegated_vars = result._result.get('_ansible_delegated_vars', None)
         if delegated_vars:
-            error = "fatal: [%s -> %s]: UNREACHABLE! => %s" % (result._host.get_name(), delegated_vars['ansible_host'], result._result)
+            error = "fatal: [%s -> %s]: UNREACHABLE! => %s" % (
+                result._host.get_name(), delegated_vars['ansible_host'],
+                result._result)
         else:
-            error = "fatal: [%s]: UNREACHABLE! => %s" % (result._host.get_name(), result._result)
-        print json.dumps({host.name: error}, indent=4)
-
-
-###############################################
-# Set server name/ip here.
-# The name/password/port will be passed to
-# this module if we integrate it into Cockpit
-server = 'example.com'
-port = 2222
-password = 'change_me'
-username = 'root'
-###############################################
-
-connection_timeout = 10
-ssh_global_args = '-o StrictHostKeyChecking=no -o PreferredAuthentications=password -o PubkeyAuthentication=no -o ConnectTimeout=%s -o Port=%s' % (connection_timeout, port)
-results_callback = ResultCallback()
-variable_manager = VariableManager()
-loader = DataLoader()
-inventory = Inventory(loader=loader, variable_manager=variable_manager,  host_list=[server])
+            error = "fatal: [%s]: UNREACHABLE! => %s" % (
+                result._host.get_name(), result._result)
+        print(json.dumps({host.name: error}, indent=4))
 
-Options = namedtuple('Options', ['listtags',
-                 'listtasks',
-                 'listhosts',
-                 'syntax',
-                 'connection',
-                 'module_path',
-                 'forks',
-                 'remote_user',
-                 'private_key_file',
-                 'ssh_common_args',
-                 'ssh_extra_args',
-                 'sftp_extra_args',
-                 'scp_extra_args',
-                 'become',
-                 'become_method',
-                 'become_user',
-                 'verbosity',
-                 'check'])
-
-options = Options(listtags=False,
-          listtasks=False,
-          listhosts=False,
-          syntax=False,
-          connection='ssh',
-          module_path=None,
-          forks=10,
-          remote_user=username,
-          private_key_file=None,
-          ssh_common_args=ssh_global_args,
-          ssh_extra_args=ssh_global_args,
-          sftp_extra_args=ssh_global_args,
-          scp_extra_args=ssh_global_args,
-          become=True,
-          become_method='sudo',
-          become_user='root',
-          verbosity=True,
-          check=False)
-
-passwords = dict(conn_pass=password)
-
-play_source =  dict(
-        name = "Ansible Play",
-        hosts = 'all',
-        gather_facts = 'yes',
-        tasks = [ 
-            # Example shell command
-            dict(action=dict(module='shell', args='updtime')),
-            # Example running other stuff:
-            dict(action=dict(module='shell', args="""date -d@$(awk '{print $1}' /proc/uptime) +'%j %T' | awk '{print $1-1"d",$2}'')),
-         ]
-    )
-play = Play().load(play_source, variable_manager=variable_manager, loader=loader)
-
-tqm = None
-try:
-    tqm = TaskQueueManager(
-              inventory=inventory,
-              variable_manager=variable_manager,
-              loader=loader,
-              options=options,
-              passwords=passwords,
-              stdout_callback=results_callback,
-          )
-    result = tqm.run(play)
-except Exception as e:
-    raise Exception("Error: %s" % e)
-finally:
-    if tqm is not None:
-        tqm.cleanup()
+
+class StreamCallback(object):
+    """ Writes one compact JSON line per task start and host
+        result, flushed as it happens, so consumers can process
+        the output while the play runs. Fields in `drop` are left
+        out and strings longer than `max_field` are truncated.
+        With `aggregate` only counters per event and up to
+        `max_failures` failures are kept in memory, written as a
+        summary line after the stats of each run.
+    """
+
+    def __init__(self, stream=None, drop=DROP_FIELDS, max_field=4096,
+                 aggregate=False, max_failures=1000):
+        self.stream = stream or sys.stdout
+        self.drop = frozenset(drop)
+        self.max_field = max_field
+        self.aggregate = aggregate
+        self.max_failures = max_failures
+        self.reset()
+
+    def reset(self):
+        self.counts = {}
+        self.failures = []
+
+    def trim(self, value):
+        if isinstance(value, dict):
+            return dict((k, self.trim(v)) for k, v in value.items()
+                        if k not in self.drop)
+        if isinstance(value, list):
+            return [self.trim(v) for v in value]
+        if isinstance(value, string_types) and \
+                self.max_field and len(value) > self.max_field:
+            return value[:self.max_field] + '...[%d more]' % (
+                len(value) - self.max_field)
+        return value
+
+    def emit(self, event, **data):
+        data.update(event=event, time=time.time())
+        self.stream.write(json.dumps(data, separators=(',', ':'),
+                                     default=str) + '\n')
+        self.stream.flush()
+
+    def result(self, event, result):
+        host = result._host.get_name()
+        task = result._task.get_name()
+        if self.aggregate:
+            self.counts[event] = self.counts.get(event, 0) + 1
+            if event in ('failed', 'unreachable') and \
+                    len(self.failures) < self.max_failures:
+                self.failures.append(
+                    {'host': host, 'task': task, 'event': event,
+                     'msg': self.trim(result._result.get('msg', ''))})
+        self.emit(event, host=host, task=task,
+                  result=self.trim(result._result))
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self.emit('task', task=task.get_name())
+
+    def v2_runner_on_ok(self, result, **kwargs):
+        self.result('ok', result)
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self.result('ignored' if ignore_errors else 'failed', result)
+
+    def v2_runner_on_skipped(self, result):
+        self.result('skipped', result)
+
+    def v2_runner_on_unreachable(self, result):
+        self.result('unreachable', result)
+
+    def v2_playbook_on_stats(self, stats):
+        summary = dict((h, stats.summarize(h)) for h in stats.processed)
+        self.emit('stats', hosts=summary)
+        if self.aggregate:
+            self.emit('summary', counts=self.counts, failures=self.failures)
+        self.reset()
+
+
+def parse_delta(value):
+    """ Seconds of a command module delta such as 0:00:01.502 """
+    try:
+        hours, minutes, seconds = value.split(':')
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    except (AttributeError, ValueError):
+        return None
+
+
+class TimingCallback(object):
+    """ Records per task and per host durations, added next to
+        the stdout callback. A host's time on a task runs from
+        the task start (or the host start where Ansible reports
+        it) to its result. Where the module reports its own run
+        time (command, shell), the rest is counted as connection
+        and transfer overhead. summary() ranks the `top` slowest
+        tasks and hosts of all runs since reset().
+    """
+
+    def __init__(self, top=10):
+        self.top = top
+        self.reset()
+
+    def reset(self):
+        self.started = None
+        self.tasks = []
+        self.hosts = {}
+        self.host_started = {}
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        now = time.time()
+        if self.started is None:
+            self.started = now
+        self.tasks.append({'task': task.get_name(), 'start': now,
+                           'end': now, 'hosts': {}})
+        self.host_started = {}
+
+    def v2_runner_on_start(self, host, task):
+        self.host_started[host.get_name()] = time.time()
+
+    def record(self, result):
+        if not self.tasks:
+            return
+        now = time.time()
+        task = self.tasks[-1]
+        name = result._host.get_name()
+        duration = now - self.host_started.get(name, task['start'])
+        task['end'] = now
+        task['hosts'][name] = duration
+
+        host = self.hosts.setdefault(name, {
+            'host': name, 'duration': 0.0, 'tasks': 0,
+            'module_time': 0.0, 'timed': 0.0})
+        host['duration'] += duration
+        host['tasks'] += 1
+        module_time = parse_delta(result._result.get('delta'))
+        if module_time is not None:
+            host['module_time'] += min(module_time, duration)
+            host['timed'] += duration
+
+    def v2_runner_on_ok(self, result, **kwargs):
+        self.record(result)
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self.record(result)
+
+    def v2_runner_on_skipped(self, result):
+        self.record(result)
+
+    def v2_runner_on_unreachable(self, result):
+        self.record(result)
+
+    def summary(self):
+        tasks = []
+        for task in self.tasks:
+            durations = sorted(task['hosts'].values())
+            entry = {'task': task['task'],
+                     'duration': task['end'] - task['start'],
+                     'hosts': len(durations)}
+            if durations:
+                slowest = max(task['hosts'], key=task['hosts'].get)
+                entry.update(median_host=durations[len(durations) // 2],
+                             slowest_host=slowest,
+                             slowest_host_time=task['hosts'][slowest])
+            tasks.append(entry)
+
+        hosts = []
+        timed = module_time = 0.0
+        for host in self.hosts.values():
+            timed += host['timed']
+            module_time += host['module_time']
+            hosts.append(dict(
+                host=host['host'], duration=host['duration'],
+                tasks=host['tasks'],
+                overhead=host['timed'] - host['module_time']))
+
+        end = max([t['end'] for t in self.tasks] or [self.started or 0])
+        return {
+            'duration': end - (self.started or end),
+            'tasks': len(tasks),
+            'hosts': len(hosts),
+            'connection_share': (timed - module_time) / timed if timed
+            else None,
+            'slowest_tasks': sorted(tasks, key=lambda t: -t['duration'])[
+                :self.top],
+            'slowest_hosts': sorted(hosts, key=lambda h: -h['duration'])[
+                :self.top],
+        }
+
+
+def ssh_args(port, connection_timeout=CONNECTION_TIMEOUT,
+             profile='password', persist=300):
+    if profile == 'password':
+        auth = ('-o PreferredAuthentications=password'
+                ' -o PubkeyAuthentication=no')
+    else:
+        # ssh keeps the first value of an option and Ansible puts
+        # its ssh_args (ansible.cfg or ANSIBLE_SSH_ARGS) first, so
+        # ControlPersist only applies when those do not set it
+        auth = ('-o PreferredAuthentications=publickey,password'
+                ' -o ControlMaster=auto -o ControlPersist=%ds' % persist)
+    return ('-o StrictHostKeyChecking=no %s'
+            ' -o ConnectTimeout=%s -o Port=%s' %
+            (auth, connection_timeout, port))
+
+
+def profile_vars(profile='password'):
+    """ Connection variables of a profile, passed to the
+        runner as extra vars so they apply to every host
+    """
+    if profile == 'password':
+        return {}
+    return {'ansible_ssh_pipelining': True}
+
+
+def make_options(username='root', port=22, forks=10, become=True,
+                 connection_timeout=CONNECTION_TIMEOUT, profile='password',
+                 private_key_file=None, persist=300):
+    ssh_global_args = ssh_args(port, connection_timeout, profile, persist)
+    # ssh_common_args are already passed to sftp and scp
+    extra_args = ssh_global_args if profile == 'password' else ''
+    return Options(listtags=False,
+                   listtasks=False,
+                   listhosts=False,
+                   syntax=False,
+                   connection='ssh',
+                   module_path=None,
+                   forks=forks,
+                   remote_user=username,
+                   private_key_file=private_key_file,
+                   ssh_common_args=ssh_global_args,
+                   ssh_extra_args=extra_args,
+                   sftp_extra_args=extra_args,
+                   scp_extra_args=extra_args,
+                   become=become,
+                   become_method='sudo',
+                   become_user='root',
+                   verbosity=True,
+                   check=False)
+
+
+class JSONFileFactCache(object):
+    """ Facts in one <host>.json file per host, fresh for ttl
+        seconds after the file was written
+    """
+
+    def __init__(self, directory, ttl=3600):
+        self.directory = directory
+        self.ttl = ttl
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def fresh(self, hosts):
+        """ {host: facts} of the hosts with fresh facts """
+        now = time.time()
+        facts = {}
+        for host in hosts:
+            path = os.path.join(self.directory, host + '.json')
+            try:
+                if now - os.stat(path).st_mtime >= self.ttl:
+                    continue
+                with open(path) as f:
+                    facts[host] = json.load(f)
+            except (IOError, OSError, ValueError):
+                continue
+        return facts
+
+    def update(self, facts):
+        for host, host_facts in facts.items():
+            path = os.path.join(self.directory, host + '.json')
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(host_facts, f)
+            os.rename(tmp, path)
+
+
+class SQLiteFactCache(object):
+    """ Facts of all hosts in one SQLite database, fresh for
+        ttl seconds after they were stored
+    """
+
+    def __init__(self, path, ttl=3600):
+        self.path = path
+        self.ttl = ttl
+        db = self.connect()
+        try:
+            db.execute('CREATE TABLE IF NOT EXISTS facts (host TEXT PRIMARY'
+                       ' KEY, updated REAL NOT NULL, facts TEXT NOT NULL)')
+        finally:
+            db.close()
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def fresh(self, hosts):
+        hosts = set(hosts)
+        db = self.connect()
+        try:
+            rows = db.execute('SELECT host, facts FROM facts'
+                              ' WHERE updated > ?',
+                              (time.time() - self.ttl,)).fetchall()
+        finally:
+            db.close()
+        return dict((host, json.loads(facts)) for host, facts in rows
+                    if host in hosts)
+
+    def update(self, facts):
+        now = time.time()
+        db = self.connect()
+        try:
+            with db:
+                db.executemany('INSERT OR REPLACE INTO facts VALUES'
+                               ' (?, ?, ?)',
+                               [(host, now, json.dumps(host_facts))
+                                for host, host_facts in facts.items()])
+        finally:
+            db.close()
+
+
+FACT_CACHES = {
+    'jsonfile': JSONFileFactCache,
+    'sqlite': SQLiteFactCache,
+}
+
+
+def make_fact_cache(spec, ttl=3600):
+    """ Fact cache from a jsonfile:<directory> or
+        sqlite:<file> spec
+    """
+    kind, sep, path = spec.partition(':')
+    if not sep or kind not in FACT_CACHES:
+        raise ValueError('Invalid fact cache %s, expected %s:path' %
+                         (spec, '|'.join(sorted(FACT_CACHES))))
+    return FACT_CACHES[kind](os.path.expanduser(path), ttl)
+
+
+class Runner(object):
+    """ Runs task lists against an inventory. `hosts` is a list
+        of host names, a comma separated string or the path of
+        an inventory file or script. The Ansible objects are set
+        up once; runs are serialised since they share them.
+        `extra_vars` apply to all hosts, see profile_vars().
+        With a `fact_cache` facts are only gathered from hosts
+        without fresh facts in the cache. `callbacks` get all
+        events next to the stdout callback, e.g. TimingCallback.
+    """
+
+    def __init__(self, hosts, options=None, password=None, callback=None,
+                 extra_vars=None, fact_cache=None, callbacks=()):
+        from ansible.parsing.dataloader import DataLoader
+        from ansible.vars import VariableManager
+        from ansible.inventory import Inventory
+
+        self.options = options or make_options()
+        self.fact_cache = fact_cache
+        self.passwords = dict(conn_pass=password)
+        self.callback = callback or ResultCallback()
+        self.callbacks = list(callbacks)
+        self.loader = DataLoader()
+        self.variable_manager = VariableManager()
+        self.variable_manager.extra_vars = dict(extra_vars or {})
+        self.inventory = Inventory(loader=self.loader,
+                                   variable_manager=self.variable_manager,
+                                   host_list=hosts)
+        self.variable_manager.set_inventory(self.inventory)
+        self.lock = threading.Lock()
+        self._tqm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def tqm(self):
+        if self._tqm is None:
+            from ansible.executor.task_queue_manager import TaskQueueManager
+            self._tqm = TaskQueueManager(
+                inventory=self.inventory,
+                variable_manager=self.variable_manager,
+                loader=self.loader,
+                options=self.options,
+                passwords=self.passwords,
+                stdout_callback=ansible_callback(self.callback),
+            )
+            self._tqm._callback_plugins.extend(
+                ansible_callback(c) for c in self.callbacks)
+        return self._tqm
+
+    def run(self, tasks, pattern='all', name='Ansible Play',
+            gather_facts=False, gather_subset=None, limit=None):
+        """ Run tasks on the hosts matching pattern, and in the
+            limit list of host names if given. Returns the task
+            queue manager result code and the play stats.
+            gather_subset limits gathered facts, e.g. 'network'
+            or '!all,!any,min'.
+        """
+        from ansible.executor.stats import AggregateStats
+
+        with self.lock:
+            tqm = self.tqm
+            # Failures of a previous run do not carry over
+            tqm.clear_failed_hosts()
+            tqm._unreachable_hosts.clear()
+            tqm._stats = AggregateStats()
+            # Nor do the counters of a run that raised
+            if isinstance(self.callback, StreamCallback):
+                self.callback.reset()
+            try:
+                if limit is not None:
+                    limit = set(limit)
+                    self.inventory.restrict_to_hosts(
+                        [h for h in self.inventory.get_hosts(pattern)
+                         if h.name in limit])
+                if gather_facts:
+                    self._gather_facts(pattern, gather_subset)
+                rc = self._run_play(dict(name=name, hosts=pattern,
+                                         gather_facts='no', tasks=tasks))
+                # Only the playbook executor sends the stats, the
+                # task queue manager leaves that to its caller
+                tqm.send_callback('v2_playbook_on_stats', tqm._stats)
+                return rc, tqm._stats
+            except Exception as e:
+                raise Exception("Error: %s" % e)
+            finally:
+                self.inventory.remove_restriction()
+
+    def _run_play(self, play_source):
+        from ansible.playbook.play import Play
+        play = Play().load(play_source,
+                           variable_manager=self.variable_manager,
+                           loader=self.loader)
+        return self.tqm.run(play)
+
+    def _gather_facts(self, pattern, gather_subset=None):
+        """ Load fresh facts from the cache and run setup on the
+            other hosts only. Hosts failing here are skipped by
+            the following play.
+        """
+        hosts = dict((h.name, h) for h in self.inventory.get_hosts(pattern))
+        cached = {}
+        if self.fact_cache is not None:
+            cached = self.fact_cache.fresh(hosts)
+        for name, facts in cached.items():
+            self.variable_manager.set_host_facts(hosts[name], facts)
+
+        stale = [name for name in hosts if name not in cached]
+        if not stale:
+            return
+
+        setup = dict(module='setup')
+        if gather_subset:
+            setup['args'] = dict(gather_subset=gather_subset)
+        self.inventory.restrict_to_hosts([hosts[name] for name in stale])
+        try:
+            self._run_play(dict(name='Gather facts', hosts=pattern,
+                                gather_facts='no',
+                                tasks=[dict(action=setup)]))
+        finally:
+            self.inventory.restrict_to_hosts(list(hosts.values()))
+
+        if self.fact_cache is not None:
+            facts = self.variable_manager._fact_cache
+            self.fact_cache.update(dict((name, facts[name]) for name in stale
+                                        if facts.get(name)))
+
+    def close(self):
+        if self._tqm is not None:
+            self._tqm.cleanup()
+            self._tqm = None
+
+
+class PipeStream(object):
+    """ File-like stream for StreamCallback that forwards each
+        line to the job service, tagged with the current job
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.job_id = None
+
+    def write(self, line):
+        self.conn.send((self.job_id, 'event', line.rstrip('\n')))
+
+    def flush(self):
+        pass
+
+
+# Job fields that select the Runner a worker uses. Jobs with
+# the same values share one, and its task queue manager.
+RUNNER_FIELDS = ('hosts', 'user', 'port', 'forks', 'become', 'profile',
+                 'persist', 'private_key', 'fact_cache', 'fact_cache_ttl')
+
+JOB_DEFAULTS = dict(pattern='all', user='root', port=22, forks=10,
+                    become=True, profile='password', persist=300,
+                    private_key=None, fact_cache=None, fact_cache_ttl=3600,
+                    gather_facts=False, gather_subset=None)
+
+
+def job_worker(conn, password, max_runners=8):
+    """ Worker process of the job service. Runs the jobs received
+        on conn one at a time and sends back their results as
+        events. Runners are kept for later jobs on the same hosts.
+    """
+    # Cancelling a job kills the worker with the forks it started
+    os.setpgrp()
+    stream = PipeStream(conn)
+    callback = StreamCallback(stream=stream)
+    # Least recently used first
+    runners = OrderedDict()
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+
+        stream.job_id = job['id']
+        conn.send((job['id'], 'start', os.getpid()))
+        try:
+            key = json.dumps([job[f] for f in RUNNER_FIELDS])
+            runner = runners.pop(key, None)
+            if runner is None:
+                if len(runners) >= max_runners:
+                    runners.popitem(last=False)[1].close()
+                fact_cache = None
+                if job['fact_cache']:
+                    fact_cache = make_fact_cache(job['fact_cache'],
+                                                 job['fact_cache_ttl'])
+                runner = Runner(
+                    job['hosts'], password=password, callback=callback,
+                    fact_cache=fact_cache,
+                    options=make_options(
+                        username=job['user'], port=job['port'],
+                        forks=job['forks'], become=job['become'],
+                        profile=job['profile'], persist=job['persist'],
+                        private_key_file=job['private_key']),
+                    extra_vars=profile_vars(job['profile']))
+            runners[key] = runner
+            rc, __ = runner.run(job['tasks'], pattern=job['pattern'],
+                                gather_facts=job['gather_facts'],
+                                gather_subset=job['gather_subset'])
+            conn.send((job['id'], 'done', rc))
+        except Exception as e:
+            conn.send((job['id'], 'error', str(e)))
+
+    for runner in runners.values():
+        runner.close()
+
+
+def shard_worker(conn, shard, hosts, limit, tasks, pattern, options,
+                 password, extra_vars, fact_cache, gather_facts,
+                 gather_subset, stream_args):
+    """ Process running one shard of a sharded run with its own
+        Runner, sending its result lines back over conn
+    """
+    stream = PipeStream(conn)
+    stream.job_id = shard
+    try:
+        if fact_cache:
+            fact_cache = make_fact_cache(*fact_cache)
+        with Runner(hosts, options=options, password=password,
+                    callback=StreamCallback(stream=stream, **stream_args),
+                    extra_vars=extra_vars, fact_cache=fact_cache) as runner:
+            rc, __ = runner.run(tasks, pattern=pattern, limit=limit,
+                                gather_facts=gather_facts,
+                                gather_subset=gather_subset)
+        conn.send((shard, 'done', rc))
+    except Exception as e:
+        conn.send((shard, 'error', str(e)))
+
+
+def run_sharded(hosts, tasks, shards, pattern='all', options=None,
+                password=None, extra_vars=None, fact_cache=None,
+                gather_facts=False, gather_subset=None, stream=None,
+                stream_args=None):
+    """ Split the hosts matching pattern into up to `shards`
+        shards, each run by its own process and task queue
+        manager. The forks of options are the total budget and
+        are shared out between the shards. The task and result
+        lines of all shards are merged into one NDJSON stream in
+        the order they arrive, tagged with their shard. Shards
+        move through the tasks at their own pace, so results of
+        different tasks interleave; group them by the task name
+        of each line, not by the preceding task line. The stats
+        and summaries of all shards are combined into one line
+        each at the end. fact_cache is a (spec, ttl) tuple, see
+        make_fact_cache().
+        Returns the worst shard result code.
+    """
+    from ansible.parsing.dataloader import DataLoader
+    from ansible.vars import VariableManager
+    from ansible.inventory import Inventory
+
+    stream = stream or sys.stdout
+    options = options or make_options()
+    inventory = Inventory(loader=DataLoader(),
+                          variable_manager=VariableManager(),
+                          host_list=hosts)
+    names = [h.name for h in inventory.get_hosts(pattern)]
+    if not names:
+        return 0
+
+    count = max(1, min(shards, options.forks, len(names)))
+    size = -(-len(names) // count)
+    chunks = [names[i:i + size] for i in range(0, len(names), size)]
+    events = queue.Queue()
+
+    def read(shard, conn, proc):
+        while True:
+            try:
+                events.put(conn.recv())
+            except (EOFError, IOError, OSError):
+                break
+        proc.join()
+        events.put((shard, 'exit', proc.exitcode))
+
+    def write(event):
+        stream.write(json.dumps(event, separators=(',', ':'),
+                                default=str) + '\n')
+        stream.flush()
+
+    for shard, chunk in enumerate(chunks):
+        forks = options.forks // len(chunks) + \
+            (1 if shard < options.forks % len(chunks) else 0)
+        conn, child = multiprocessing.Pipe()
+        proc = multiprocessing.Process(target=shard_worker, args=(
+            child, shard, hosts, chunk, tasks, pattern,
+            options._replace(forks=forks), password, extra_vars, fact_cache,
+            gather_facts, gather_subset, stream_args or {}))
+        proc.start()
+        child.close()
+        reader = threading.Thread(target=read, args=(shard, conn, proc))
+        reader.daemon = True
+        reader.start()
+
+    rc = 0
+    finished = set()
+    running = len(chunks)
+    stats = {}
+    summary = None
+    while running:
+        shard, kind, value = events.get()
+        if kind == 'event':
+            event = json.loads(value)
+            if event['event'] == 'stats':
+                # Shards have disjoint hosts
+                stats.update(event['hosts'])
+                continue
+            if event['event'] == 'summary':
+                summary = summary or {'counts': {}, 'failures': []}
+                for name, count in event['counts'].items():
+                    summary['counts'][name] = \
+                        summary['counts'].get(name, 0) + count
+                summary['failures'].extend(event['failures'])
+                continue
+            event['shard'] = shard
+            write(event)
+        elif kind == 'done':
+            finished.add(shard)
+            rc = max(rc, value)
+        elif kind == 'error':
+            finished.add(shard)
+            rc = max(rc, 1)
+            write({'event': 'error', 'shard': shard, 'msg': value,
+                   'time': time.time()})
+        else:
+            running -= 1
+            if shard not in finished:
+                rc = max(rc, 1)
+                write({'event': 'error', 'shard': shard,
+                       'msg': 'Shard exited with %s' % value,
+                       'time': time.time()})
+
+    write({'event': 'stats', 'hosts': stats, 'shards': len(chunks),
+           'time': time.time()})
+    if summary is not None:
+        summary['failures'] = summary['failures'][
+            :(stream_args or {}).get('max_failures', 1000)]
+        write(dict(summary, event='summary', time=time.time()))
+    return rc
+
+
+class JobService(object):
+    """ Queue of ad-hoc jobs run by a pool of worker processes.
+        Keeps the state and the last `max_events` result lines of
+        the last `keep_jobs` jobs.
+    """
+
+    def __init__(self, workers=4, password=None, max_events=10000,
+                 keep_jobs=1000):
+        self.size = workers
+        self.password = password
+        self.max_events = max_events
+        self.keep_jobs = keep_jobs
+        self.jobs = OrderedDict()
+        self.pending = deque()
+        self.workers = []
+        self.cond = threading.Condition()
+        self.counter = 0
+        self.stopping = False
+
+    def start(self):
+        with self.cond:
+            for __ in range(self.size):
+                self.workers.append(self.spawn())
+
+    def spawn(self):
+        """ Start a worker process and the thread reading its
+            events. Each worker has its own pipe, so killing one
+            cannot leave a shared queue locked.
+        """
+        conn, child = multiprocessing.Pipe()
+        # Not daemonic, daemonic processes cannot start the Ansible
+        # worker processes; stop() and cancel() end the workers
+        proc = multiprocessing.Process(target=job_worker,
+                                       args=(child, self.password))
+        proc.start()
+        child.close()
+        worker = {'proc': proc, 'conn': conn, 'job': None}
+        reader = threading.Thread(target=self.read_events, args=(worker,))
+        reader.daemon = True
+        reader.start()
+        return worker
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            for worker in self.workers:
+                if worker['job'] is None:
+                    worker['conn'].send(None)
+                else:
+                    self.kill(worker)
+        for worker in self.workers:
+            worker['proc'].join(10)
+
+    def kill(self, worker):
+        try:
+            os.killpg(worker['proc'].pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def submit(self, spec):
+        job = dict(JOB_DEFAULTS)
+        job.update((k, v) for k, v in spec.items() if k in JOB_DEFAULTS)
+        if not spec.get('hosts'):
+            raise ValueError('Job without hosts')
+        job['hosts'] = spec['hosts']
+        if spec.get('tasks'):
+            job['tasks'] = spec['tasks']
+        elif spec.get('commands'):
+            job['tasks'] = [dict(action=dict(module='shell', args=c))
+                            for c in spec['commands']]
+        else:
+            raise ValueError('Job without tasks or commands')
+        if job['profile'] not in CONNECTION_PROFILES:
+            raise ValueError('Unknown profile %s' % job['profile'])
+
+        with self.cond:
+            self.counter += 1
+            job['id'] = '%d-%d' % (int(time.time()), self.counter)
+            self.jobs[job['id']] = dict(
+                id=job['id'], state='queued', submitted=time.time(),
+                started=None, finished=None, rc=None, error=None,
+                worker=None, base=0, events=deque(maxlen=self.max_events),
+                spec=job)
+            self.pending.append(job['id'])
+            self.expire()
+            self.dispatch()
+        return job['id']
+
+    def expire(self):
+        """ Forget the oldest finished jobs over keep_jobs """
+        finished = [i for i, j in self.jobs.items() if j['finished']]
+        for job_id in finished[:max(0, len(self.jobs) - self.keep_jobs)]:
+            del self.jobs[job_id]
+
+    def dispatch(self):
+        """ Hand queued jobs to idle workers, cond held """
+        for worker in self.workers:
+            if not self.pending:
+                break
+            if worker['job'] is None:
+                job_id = self.pending.popleft()
+                worker['job'] = job_id
+                worker['conn'].send(self.jobs[job_id]['spec'])
+
+    def read_events(self, worker):
+        while True:
+            try:
+                job_id, kind, value = worker['conn'].recv()
+            except (EOFError, IOError, OSError):
+                self.worker_exited(worker)
+                return
+            with self.cond:
+                job = self.jobs.get(job_id)
+                if job is None or job['finished']:
+                    continue
+                if kind == 'event':
+                    if len(job['events']) == self.max_events:
+                        job['base'] += 1
+                    job['events'].append(value)
+                elif kind == 'start':
+                    job.update(state='running', started=time.time(),
+                               worker=value)
+                else:
+                    job.update(state='done' if kind == 'done' else 'failed',
+                               finished=time.time(),
+                               rc=value if kind == 'done' else None,
+                               error=value if kind == 'error' else None)
+                    worker['job'] = None
+                    self.dispatch()
+                self.cond.notify_all()
+
+    def worker_exited(self, worker):
+        """ Fail the job of a worker that died and replace it,
+            unless it was stopped or cancelled
+        """
+        with self.cond:
+            if self.stopping or not any(w is worker for w in self.workers):
+                return
+            worker['proc'].join(1)
+            job = self.jobs.get(worker['job'])
+            if job is not None and not job['finished']:
+                job.update(state='failed', finished=time.time(),
+                           error='Worker exited with %s' %
+                           worker['proc'].exitcode)
+            self.workers[self.workers.index(worker)] = self.spawn()
+            self.dispatch()
+            self.cond.notify_all()
+
+    def cancel(self, job_id):
+        killed = []
+        with self.cond:
+            job = self.jobs[job_id]
+            if job['finished']:
+                return False
+            if job_id in self.pending:
+                self.pending.remove(job_id)
+            for n, worker in enumerate(self.workers):
+                if worker['job'] == job_id:
+                    killed.append(worker)
+                    self.workers[n] = self.spawn()
+            job.update(state='cancelled', finished=time.time())
+            self.dispatch()
+            self.cond.notify_all()
+
+        # The worker is no longer in self.workers, so its exit is
+        # ignored; other requests need not wait for it to go
+        for worker in killed:
+            self.kill(worker)
+            worker['proc'].join(10)
+            worker['conn'].close()
+        return True
+
+    def status(self, job_id=None):
+        with self.cond:
+            jobs = [self.jobs[job_id]] if job_id else self.jobs.values()
+            return [dict((k, v) for k, v in job.items()
+                         if k not in ('events', 'spec', 'base'))
+                    for job in jobs]
+
+    def stream(self, job_id, offset=0, timeout=30):
+        """ Result lines from offset on, waiting up to timeout for
+            new ones. Yields (offset, line) until the job finished,
+            or was expired while streaming. Raises KeyError for an
+            unknown job.
+        """
+        first = True
+        while True:
+            with self.cond:
+                job = self.jobs.get(job_id)
+                if job is None:
+                    if first:
+                        raise KeyError(job_id)
+                    return
+                first = False
+                if offset - job['base'] >= len(job['events']) and \
+                        not job['finished']:
+                    self.cond.wait(timeout)
+                offset = max(offset, job['base'])
+                lines = list(job['events'])[offset - job['base']:]
+                finished = job['finished']
+            for line in lines:
+                yield offset, line
+                offset += 1
+            if finished and not lines:
+                return
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        service = self.server.service
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            op = request.get('op')
+            if op == 'stream':
+                for offset, line in service.stream(request['id'],
+                                                   request.get('offset', 0)):
+                    self.wfile.write(('%s\n' % line).encode('utf-8'))
+                try:
+                    response = service.status(request['id'])[0]
+                except KeyError:
+                    response = {'id': request['id'], 'state': 'expired'}
+            elif op == 'submit':
+                response = {'id': service.submit(request['job'])}
+            elif op == 'status':
+                response = {'jobs': service.status(request.get('id'))}
+            elif op == 'cancel':
+                response = {'cancelled': service.cancel(request['id'])}
+            else:
+                response = {'error': 'Unknown op %s' % op}
+        except KeyError as e:
+            response = {'error': 'Unknown job %s' % e.args[0]}
+        except Exception as e:
+            response = {'error': str(e)}
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve_jobs(path, workers=4, password=None):
+    """ Run the job service on a Unix socket until SIGTERM """
+    service = JobService(workers, password)
+    service.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    if os.path.exists(path):
+        os.unlink(path)
+    server = JobServer(path, JobHandler)
+    server.service = service
+    LOG.info("Serving jobs on %s with %d workers" % (path, workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+        service.stop()
+    return 0
+
+
+def job_request(path, request):
+    """ Send one request to the job service. Yields the lines
+        of the response, several for stream requests.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        for line in sock.makefile('rb'):
+            yield json.loads(line.decode('utf-8'))
+    finally:
+        sock.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Run shell commands on hosts with the Ansible API')
+
+    parser.add_argument('hosts', metavar='host', nargs='*',
+                        help='Host names, or one inventory file')
+
+    parser.add_argument('--command', '-c', metavar='cmd', action='append',
+                        dest='commands',
+                        help='Shell command to run, can be repeated.'
+                             ' Default: uptime')
+
+    parser.add_argument('--pattern', metavar='pattern', default='all',
+                        help='Inventory host pattern. Default: %(default)s')
+
+    parser.add_argument('--user', '-u', metavar='name', default='root',
+                        help='Remote user. Default: %(default)s')
+
+    parser.add_argument('--port', '-p', metavar='int', type=int, default=22,
+                        help='SSH port. Default: %(default)s')
+
+    parser.add_argument('--forks', '-f', metavar='int', type=int, default=10,
+                        help='Hosts handled in parallel.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--profile', choices=CONNECTION_PROFILES,
+                        default='password',
+                        help='SSH connection profile. performance reuses'
+                             ' connections and pipelines modules.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--persist', metavar='sec', type=int, default=300,
+                        help='How long idle multiplexed connections stay'
+                             ' open with --profile performance, unless'
+                             ' Ansible\'s ssh_args set ControlPersist.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--private-key', metavar='file', type=str,
+                        help='SSH private key, instead of the agent or'
+                             ' default keys')
+
+    parser.add_argument('--ask-pass', '-k', action='store_true',
+                        help='Prompt for the SSH password instead of'
+                             ' reading ANSIBLE_SSH_PASS')
+
+    parser.add_argument('--facts', action='store_true',
+                        help='Gather facts before running the commands')
+
+    parser.add_argument('--gather-subset', metavar='list', type=str,
+                        help='Fact subsets to gather, e.g. network or'
+                             ' !all,!any,min')
+
+    parser.add_argument('--fact-cache', metavar='spec', type=str,
+                        help='Keep gathered facts in jsonfile:<directory>'
+                             ' or sqlite:<file> and only gather from hosts'
+                             ' without fresh facts')
+
+    parser.add_argument('--fact-cache-ttl', metavar='sec', type=float,
+                        default=3600,
+                        help='How long cached facts stay fresh.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--output', choices=('pretty', 'ndjson'),
+                        default='pretty',
+                        help='pretty prints each result indented, ndjson'
+                             ' streams one JSON line per event with a'
+                             ' summary at the end. Default: %(default)s')
+
+    parser.add_argument('--max-field', metavar='bytes', type=int,
+                        default=4096,
+                        help='Truncate longer strings in ndjson output,'
+                             ' 0 to keep them whole. Default: %(default)s')
+
+    parser.add_argument('--keep-facts', action='store_true',
+                        help='Include gathered facts in ndjson output')
+
+    parser.add_argument('--shards', metavar='int', type=int, default=1,
+                        help='Split the hosts between this many processes,'
+                             ' each with its own task queue manager, sharing'
+                             ' --forks between them. Output is ndjson.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--timings', metavar='file', type=str,
+                        help='Write a JSON summary of task and host'
+                             ' durations, - for stderr')
+
+    parser.add_argument('--top', metavar='int', type=int, default=10,
+                        help='Slowest tasks and hosts in --timings.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--socket', metavar='path', type=str,
+                        help='Job service socket')
+
+    parser.add_argument('--serve', action='store_true',
+                        help='Run the job service on --socket')
+
+    parser.add_argument('--workers', metavar='int', type=int, default=4,
+                        help='Job service worker processes.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--submit', action='store_true',
+                        help='Queue the commands as a job on the service'
+                             ' at --socket and print its id')
+
+    parser.add_argument('--follow', action='store_true',
+                        help='Stream the results of the submitted job')
+
+    parser.add_argument('--status', metavar='id', nargs='?', const='',
+                        help='Show the state of one or all jobs')
+
+    parser.add_argument('--stream', metavar='id', type=str,
+                        help='Print the results of a job as they come')
+
+    parser.add_argument('--cancel', metavar='id', type=str,
+                        help='Cancel a queued or running job')
+
+    args = parser.parse_args()
+    client = args.submit or args.status is not None or args.stream or \
+        args.cancel
+    if (args.serve or client) and not args.socket:
+        parser.error('--serve, --submit, --status, --stream and --cancel'
+                     ' need --socket')
+    if not args.hosts and not (args.serve or client) or \
+            args.submit and not args.hosts:
+        parser.error('No hosts given')
+    if args.shards > 1 and args.timings:
+        parser.error('--timings does not support --shards')
+    if args.fact_cache:
+        try:
+            make_fact_cache(args.fact_cache, args.fact_cache_ttl)
+        except (ValueError, OSError, sqlite3.Error) as e:
+            parser.error(str(e))
+    return args
+
+
+def job_client(args, hosts, tasks):
+    """ Talk to the job service. Prints the JSON responses,
+        returns 0 unless the service reported an error.
+    """
+    if args.submit:
+        job = dict(hosts=hosts, tasks=tasks, pattern=args.pattern,
+                   user=args.user, port=args.port, forks=args.forks,
+                   profile=args.profile, persist=args.persist,
+                   private_key=args.private_key, fact_cache=args.fact_cache,
+                   fact_cache_ttl=args.fact_cache_ttl,
+                   gather_facts=args.facts, gather_subset=args.gather_subset)
+        request = {'op': 'submit', 'job': job}
+    elif args.status is not None:
+        request = {'op': 'status', 'id': args.status or None}
+    elif args.stream:
+        request = {'op': 'stream', 'id': args.stream}
+    else:
+        request = {'op': 'cancel', 'id': args.cancel}
+
+    try:
+        for response in job_request(args.socket, request):
+            print(json.dumps(response, sort_keys=True))
+            if 'error' in response:
+                return 1
+            if args.submit and args.follow:
+                for line in job_request(args.socket, {
+                        'op': 'stream', 'id': response['id']}):
+                    print(json.dumps(line, sort_keys=True))
+    except socket.error as e:
+        sys.stderr.write("Error: cannot reach %s: %s\n" % (args.socket, e))
+        return 1
+    return 0
+
+
+def main():
+    args = parse_args()
+
+    if args.ask_pass:
+        password = getpass.getpass('SSH password: ')
+    else:
+        password = os.environ.get('ANSIBLE_SSH_PASS')
+
+    if args.serve:
+        logging.basicConfig(level=logging.INFO,
+                            format='%(levelname)s: %(message)s')
+        return serve_jobs(args.socket, args.workers, password)
+
+    hosts = args.hosts
+    if len(hosts) == 1 and os.path.exists(hosts[0]):
+        hosts = os.path.abspath(hosts[0])
+
+    tasks = DEFAULT_TASKS
+    if args.commands:
+        tasks = [dict(action=dict(module='shell', args=c))
+                 for c in args.commands]
+
+    if args.socket:
+        return job_client(args, hosts, tasks)
+
+    drop = DROP_FIELDS
+    if args.keep_facts:
+        drop = [f for f in drop if f != 'ansible_facts']
+    callback = None
+    if args.output == 'ndjson':
+        callback = StreamCallback(drop=drop, max_field=args.max_field,
+                                  aggregate=True)
+
+    options = make_options(username=args.user, port=args.port,
+                           forks=args.forks, profile=args.profile,
+                           persist=args.persist,
+                           private_key_file=args.private_key)
+    if args.shards > 1:
+        return run_sharded(
+            hosts, tasks, args.shards, pattern=args.pattern,
+            options=options, password=password,
+            extra_vars=profile_vars(args.profile),
+            fact_cache=args.fact_cache and (args.fact_cache,
+                                            args.fact_cache_ttl),
+            gather_facts=args.facts, gather_subset=args.gather_subset,
+            stream_args=dict(drop=drop, max_field=args.max_field,
+                             aggregate=True))
+    fact_cache = None
+    if args.fact_cache:
+        fact_cache = make_fact_cache(args.fact_cache, args.fact_cache_ttl)
+    callbacks = []
+    if args.timings:
+        callbacks.append(TimingCallback(args.top))
+    with Runner(hosts, options=options, password=password,
+                callback=callback, fact_cache=fact_cache,
+                callbacks=callbacks,
+                extra_vars=profile_vars(args.profile)) as runner:
+        rc, __ = runner.run(tasks, pattern=args.pattern,
+                            gather_facts=args.facts,
+                            gather_subset=args.gather_subset)
+
+    if args.timings:
+        summary = json.dumps(callbacks[0].summary(), indent=2,
+                             sort_keys=True)
+        if args.timings == '-':
+            sys.stderr.write(summary + '\n')
+        else:
+            with open(args.timings, 'w') as f:
+                f.write(summary + '\n')
+    return rc
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+""" Benchmark the api_ansible.py connection profiles.
+    Runs the same list of trivial tasks against a host with
+    each profile and reports the time per task, so the SSH
+    handshake and file transfer overhead the performance
+    profile saves can be compared. Needs Ansible and a
+    reachable sshd, e.g. on localhost with a key in the agent,
+    or --simulate to run locally through
+    connection_plugins/simulated_ssh.py with a fixed cost per
+    ssh handshake and file transfer.
+"""
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import api_ansible  # noqa: E402
+
+
+class CountingCallback(object):
+    """ Counts results without printing them """
+
+    def __init__(self):
+        self.counts = {'ok': 0, 'failed': 0, 'unreachable': 0}
+
+    def v2_runner_on_ok(self, result, **kwargs):
+        self.counts['ok'] += 1
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self.counts['failed'] += 1
+
+    def v2_runner_on_unreachable(self, result):
+        self.counts['unreachable'] += 1
+
+
+def git_version():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], cwd=HERE,
+            stderr=subprocess.STDOUT).decode().strip()
+    except Exception:
+        return None
+
+
+def run_profile(profile, opts, password):
+    """ Time --runs runs of --tasks tasks with one runner, as a
+        long lived process would use it. The first run includes
+        opening the connections.
+    """
+    callback = CountingCallback()
+    options = api_ansible.make_options(
+        username=opts.user, port=opts.port, forks=opts.forks,
+        become=opts.become, profile=profile, persist=opts.persist,
+        private_key_file=opts.private_key)
+    extra_vars = api_ansible.profile_vars(profile)
+    if opts.simulate:
+        options = options._replace(connection='simulated_ssh')
+        extra_vars['ansible_python_interpreter'] = sys.executable
+        # No master survives from the previous profile
+        os.environ['SIMULATED_SSH_CONTROL_DIR'] = tempfile.mkdtemp(
+            prefix='simulated_ssh-')
+    tasks = [dict(action=dict(module='command', args='true'))
+             for __ in range(opts.tasks)]
+    times = []
+    with api_ansible.Runner(opts.hosts, options=options, password=password,
+                            callback=callback,
+                            extra_vars=extra_vars) as runner:
+        for __ in range(opts.runs):
+            start = time.time()
+            runner.run(tasks, gather_facts=False)
+            times.append(time.time() - start)
+    if opts.simulate:
+        shutil.rmtree(os.environ['SIMULATED_SSH_CONTROL_DIR'])
+
+    steady = sorted(times[1:] or times)
+    return {'profile': profile,
+            'first_run': times[0],
+            'first_run_per_task': times[0] / opts.tasks,
+            'steady_median': steady[len(steady) // 2],
+            'steady_per_task': steady[len(steady) // 2] / opts.tasks,
+            'results': callback.counts}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark api_ansible.py connection profiles')
+
+    parser.add_argument('hosts', metavar='host', nargs='*',
+                        default=['localhost'],
+                        help='Hosts to run on. Default: localhost')
+
+    parser.add_argument('--profile', metavar='name', action='append',
+                        choices=api_ansible.CONNECTION_PROFILES,
+                        dest='profiles',
+                        help='Profile to measure, can be repeated.'
+                             ' Default: all')
+
+    parser.add_argument('--tasks', metavar='int', type=int, default=20,
+                        help='Tasks per run. Default: %(default)s')
+
+    parser.add_argument('--runs', metavar='int', type=int, default=4,
+                        help='Runs per profile. Default: %(default)s')
+
+    parser.add_argument('--user', '-u', metavar='name',
+                        default=os.environ.get('USER', 'root'),
+                        help='Remote user. Default: %(default)s')
+
+    parser.add_argument('--port', '-p', metavar='int', type=int, default=22,
+                        help='SSH port. Default: %(default)s')
+
+    parser.add_argument('--forks', '-f', metavar='int', type=int, default=10,
+                        help='Default: %(default)s')
+
+    parser.add_argument('--persist', metavar='sec', type=int, default=300,
+                        help='ControlPersist of the performance profile,'
+                             ' unless Ansible\'s ssh_args set one.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--private-key', metavar='file', type=str,
+                        help='SSH private key for the performance profile')
+
+    parser.add_argument('--become', action='store_true',
+                        help='Run the tasks with sudo')
+
+    parser.add_argument('--simulate', action='store_true',
+                        help='Run locally with the simulated_ssh stand-in'
+                             ' connection instead of ssh')
+
+    parser.add_argument('--handshake', metavar='ms', type=float, default=150,
+                        help='Cost of an ssh handshake with --simulate.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--transfer', metavar='ms', type=float, default=30,
+                        help='Cost of a file transfer with --simulate.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--output', '-o', metavar='file', type=str,
+                        help='Write JSON results to file instead of stdout')
+
+    return parser.parse_args()
+
+
+def main():
+    opts = parse_args()
+    password = os.environ.get('ANSIBLE_SSH_PASS')
+    if opts.simulate:
+        from ansible.plugins import connection_loader
+        connection_loader.add_directory(
+            os.path.join(HERE, 'connection_plugins'))
+        # Read by the plugin in the worker processes
+        os.environ['SIMULATED_SSH_HANDSHAKE'] = str(opts.handshake)
+        os.environ['SIMULATED_SSH_TRANSFER'] = str(opts.transfer)
+
+    results = []
+    for profile in opts.profiles or api_ansible.CONNECTION_PROFILES:
+        if profile == 'password' and not password and not opts.simulate:
+            sys.stderr.write("Skipping password profile,"
+                             " ANSIBLE_SSH_PASS is not set\n")
+            continue
+        results.append(run_profile(profile, opts, password))
+        sys.stderr.write("%(profile)s: first run %(first_run_per_task).3fs"
+                         "/task, then %(steady_per_task).3fs/task\n" %
+                         results[-1])
+
+    output = {'version': git_version(),
+              'python': platform.python_version(),
+              'hosts': opts.hosts,
+              'tasks': opts.tasks,
+              'runs': opts.runs,
+              'forks': opts.forks,
+              'simulate': opts.simulate and {'handshake': opts.handshake,
+                                             'transfer': opts.transfer},
+              'timestamp': int(time.time()),
+              'results': results}
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(output, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
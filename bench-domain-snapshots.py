@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import types
+
+""" Benchmark doDomainSnapshots.py retention and creation paths.
+    Runs against an in-process fake of the libvirt snapshot API
+    (default) or a real libvirt URI such as test:///default.
+    Results are written as JSON to compare between versions.
+"""
+
+
+class FakeSnapshot(object):
+
+    def __init__(self, dom, name, c_time):
+        self.dom = dom
+        self.name = name
+        self.c_time = c_time
+
+    def getName(self):
+        return self.name
+
+    def getXMLDesc(self, flags=0):
+        self.dom.rpc()
+        return ('<domainsnapshot><name>%s</name>'
+                '<creationTime>%d</creationTime>'
+                '<state>running</state></domainsnapshot>' %
+                (self.name, self.c_time))
+
+    def delete(self, flags=0):
+        self.dom.rpc()
+        with self.dom.lock:
+            del self.dom.snapshots[self.name]
+
+
+class FakeDomain(object):
+
+    def __init__(self, name, latency=0.0):
+        self._name = name
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.snapshots = {}
+        self.clock = 1000000000
+
+    def rpc(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def name(self):
+        return self._name
+
+    def snapshotListNames(self, flags=0):
+        self.rpc()
+        with self.lock:
+            return list(self.snapshots)
+
+    def snapshotLookupByName(self, name, flags=0):
+        self.rpc()
+        with self.lock:
+            try:
+                return self.snapshots[name]
+            except KeyError:
+                raise FakeLibvirt.libvirtError('Snapshot %s not found' % name)
+
+    def snapshotCreateXML(self, xml, flags=0):
+        self.rpc()
+        name = xml.split('<name>', 1)[1].split('</name>', 1)[0].strip()
+        with self.lock:
+            self.clock += 1
+            snapshot = FakeSnapshot(self, name, self.clock)
+            self.snapshots[name] = snapshot
+        return snapshot
+
+
+class FakeConnection(object):
+
+    def __init__(self, domains):
+        self.domains = domains
+
+    def lookupByName(self, name):
+        try:
+            return self.domains[name]
+        except KeyError:
+            raise FakeLibvirt.libvirtError('Domain %s not found' % name)
+
+    def close(self):
+        pass
+
+
+class FakeLibvirt(types.ModuleType):
+    """ Stands in for the libvirt module. Every URI is a
+        separate hypervisor holding its own set of domains.
+    """
+
+    class libvirtError(Exception):
+        pass
+
+    def __init__(self, latency=0.0):
+        types.ModuleType.__init__(self, 'libvirt')
+        self.latency = latency
+        self.hypervisors = {}
+
+    def open(self, uri):
+        return FakeConnection(self.hypervisors.setdefault(uri, {}))
+
+    def lookup(self, uri, name):
+        return self.hypervisors[uri][name]
+
+    def populate(self, uri, domains, snapshots):
+        hv = self.hypervisors.setdefault(uri, {})
+        names = []
+        for d in range(domains):
+            dom = FakeDomain('bench-%d' % d, latency=self.latency)
+            for s in range(snapshots):
+                dom.snapshotCreateXML('<domainsnapshot><name>snap-%d</name>'
+                                      '</domainsnapshot>' % s)
+            hv[dom.name()] = dom
+            names.append(dom.name())
+        return names
+
+
+class LibvirtBackend(object):
+    """ Populates a real libvirt connection, e.g. test:///default.
+        Snapshots are redefined with distinct creation times so
+        retention has a deterministic order.
+    """
+
+    def __init__(self, libvirt, uri):
+        self.libvirt = libvirt
+        self.uri = uri
+        self.conn = libvirt.open(uri)
+
+    def lookup(self, uri, name):
+        return self.conn.lookupByName(name)
+
+    def populate(self, uri, domains, snapshots):
+        names = []
+        base = int(time.time()) - domains * snapshots
+        for d in range(domains):
+            name = 'bench-%d' % d
+            try:
+                dom = self.conn.lookupByName(name)
+                for snap in dom.snapshotListNames():
+                    dom.snapshotLookupByName(snap).delete()
+            except self.libvirt.libvirtError:
+                dom = self.conn.defineXML(
+                    "<domain type='test'><name>%s</name><memory>8192</memory>"
+                    "<os><type>hvm</type></os></domain>" % name)
+            dom_xml = dom.XMLDesc(0)
+            for s in range(snapshots):
+                dom.snapshotCreateXML(
+                    '<domainsnapshot><name>snap-%d</name>'
+                    '<creationTime>%d</creationTime><state>shutoff</state>'
+                    '%s</domainsnapshot>' % (s, base + s, dom_xml),
+                    self.libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_REDEFINE)
+            names.append(name)
+        return names
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark doDomainSnapshots.py')
+
+    parser.add_argument('--uri', metavar='uri', type=str,
+                        help='Real libvirt URI to benchmark against,'
+                             ' e.g. test:///default. Defaults to an'
+                             ' in-process fake.')
+
+    parser.add_argument('--snapshots', metavar='list', type=int_list,
+                        default=[10, 100, 500],
+                        help='Snapshot counts per domain.'
+                             ' Default: 10,100,500')
+
+    parser.add_argument('--domains', metavar='list', type=int_list,
+                        default=[1, 10, 50],
+                        help='Domain counts for multi-domain runs.'
+                             ' Default: 1,10,50')
+
+    parser.add_argument('--hosts', metavar='int', type=int, default=4,
+                        help='Hypervisors for multi-domain runs (fake only).'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--host-workers', metavar='int', type=int,
+                        default=4,
+                        help='Domains in parallel per hypervisor.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--keep', metavar='int', type=int, default=2,
+                        help='Snapshots to keep. Default: %(default)s')
+
+    parser.add_argument('--latency', metavar='ms', type=float, default=0.0,
+                        help='Simulated per-call RPC latency for the fake.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--repeat', metavar='int', type=int, default=3,
+                        help='Repetitions per case. Default: %(default)s')
+
+    parser.add_argument('--output', '-o', metavar='file', type=str,
+                        help='Write JSON results to file instead of stdout')
+
+    return parser.parse_args()
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def git_version():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).decode().strip()
+    except Exception:
+        return None
+
+
+def timed(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        setup = func()
+        start = time.time()
+        result = setup()
+        timings.append(time.time() - start)
+    timings.sort()
+    return {'min': timings[0],
+            'median': timings[len(timings) // 2],
+            'max': timings[-1],
+            'result': result}
+
+
+def main():
+    opts = parse_args()
+
+    if opts.uri:
+        import libvirt
+        backend = LibvirtBackend(libvirt, opts.uri)
+        uris = [opts.uri]
+    else:
+        libvirt = FakeLibvirt(latency=opts.latency / 1000.0)
+        sys.modules['libvirt'] = libvirt
+        backend = libvirt
+        uris = ['fake://hv%d/system' % h for h in range(opts.hosts)]
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import doDomainSnapshots as snap
+    snap.LOG.addHandler(logging.NullHandler())
+    snap.LOG.setLevel(logging.ERROR)
+
+    def snap_args(domains, uris, keep):
+        argv = ['--keep', str(keep), '--host-workers',
+                str(opts.host_workers), '--parallel', str(len(uris))]
+        for d in domains:
+            argv += ['--domain', d]
+        for u in uris:
+            argv += ['--qemu-uri', u]
+        return snap.parse_args(argv)
+
+    results = []
+
+    for count in opts.snapshots:
+        def delete_case():
+            name = backend.populate(uris[0], 1, count)[0]
+            dom = backend.lookup(uris[0], name)
+            return lambda: len(snap.delete_older_snapshots(dom, opts.keep))
+        r = timed(delete_case, opts.repeat)
+        r.update(case='delete', domains=1, snapshots=count)
+        results.append(r)
+
+        def create_case():
+            names = backend.populate(uris[0], 1, count)
+            args = snap_args(names, uris[:1], count)
+            pool = snap.ConnectionPool()
+            return lambda: len([x for x in snap.run_snapshots(args, pool)
+                                if x['snapshot']])
+        r = timed(create_case, opts.repeat)
+        r.update(case='create', domains=1, snapshots=count)
+        results.append(r)
+
+    for domains in opts.domains:
+        count = opts.snapshots[0]
+
+        def multi_case():
+            names = []
+            for uri in uris:
+                names = backend.populate(uri, domains, count)
+            args = snap_args(names, uris, opts.keep)
+            pool = snap.ConnectionPool()
+            return lambda: len([x for x in snap.run_snapshots(args, pool)
+                                if x['snapshot']])
+        r = timed(multi_case, opts.repeat)
+        r.update(case='multi', domains=domains * len(uris),
+                 hosts=len(uris), snapshots=count)
+        results.append(r)
+
+    output = {'version': git_version(),
+              'python': platform.python_version(),
+              'backend': opts.uri or 'fake',
+              'latency_ms': opts.latency,
+              'keep': opts.keep,
+              'host_workers': opts.host_workers,
+              'repeat': opts.repeat,
+              'timestamp': int(time.time()),
+              'results': results}
+
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(output, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+import argparse
+import fnmatch
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+""" Synthetic crm_mon -X generator, benchmark and correctness
+    suite for check-pacemaker-cluster.py.
+    The benchmark times parsing and evaluation of generated
+    clusters of increasing size. The correctness suite runs a
+    fixed set of generated scenarios and compares return codes
+    and messages with those of the baseline checker, recorded in
+    a golden file, so performance work does not change what the
+    checker reports. Intended differences are listed in
+    KNOWN_DIFFERENCES; cases the baseline cannot run are recorded
+    from the current checker.
+"""
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CHECKER = os.path.join(HERE, 'check-pacemaker-cluster.py')
+GOLDEN = os.path.join(HERE, 'pacemaker-check-golden.json')
+
+LAST_UPDATE = 'Mon Oct 19 10:00:00 2026'
+
+# Scenario name -> generate_crm_xml() arguments
+SCENARIOS = [
+    ('healthy', dict(nodes=3, primitives=6, clones=2, ops=3)),
+    ('healthy-large', dict(nodes=16, primitives=40, clones=6, ops=4)),
+    ('maintenance', dict(nodes=3, primitives=4, clones=1, ops=2,
+                         maintenance=True)),
+    ('stonith-disabled', dict(nodes=3, primitives=4, clones=1, ops=2,
+                              stonith=False)),
+    ('no-fencing', dict(nodes=3, primitives=4, clones=1, ops=2,
+                        fencing=False)),
+    ('missing-node', dict(nodes=3, primitives=4, clones=1, ops=2,
+                          configured=4)),
+] + [('failures-%d' % seed, dict(nodes=5, primitives=12, clones=3, ops=4,
+                                 failures=0.15, seed=seed))
+     for seed in range(1, 9)]
+
+# Option set name -> checker arguments. {state} is a history
+# state file shared by the option sets of a scenario, in order.
+OPTION_SETS = [
+    ('default', []),
+    ('history', ['--history']),
+    ('stonith', ['--stonith']),
+    ('all', ['--history', '--stonith']),
+    ('resource', ['--resource', 'prim-1']),
+    ('resource-clone', ['--resource', 'clone-0']),
+    ('resource-missing', ['--resource', 'missing']),
+    ('resources', ['--resource', 'prim-1', '--resource', 'clone-0',
+                   '--resource', 'missing']),
+    ('regex', ['--resource-regex', '^prim-[0-3]$', '--stonith']),
+    # Failure counts stay within the window until 2036
+    ('watermark', ['--history', '--history-state', '{state}',
+                   '--history-window', '315360000']),
+    ('watermark-rerun', ['--history', '--history-state', '{state}',
+                         '--history-window', '315360000']),
+]
+
+
+def scenario_argv(argv, state):
+    return [a.replace('{state}', state) for a in argv]
+
+
+def chance(rng, p):
+    return p > 0 and rng.random() < p
+
+
+def pick(rng, items):
+    # Not rng.choice(), its result differs between Python 2 and 3
+    return items[int(rng.random() * len(items))]
+
+
+def generate_crm_xml(nodes=3, primitives=6, clones=2, ops=5, failures=0.0,
+                     seed=0, stonith=True, fencing=True, maintenance=False,
+                     configured=None):
+    """ crm_mon -X like document with `nodes` nodes, one
+        fence_ipmilan device per node, `primitives` primitives,
+        `clones` clones with one instance per node and `ops`
+        history entries per resource and node. Each injection
+        point fails with probability `failures`.
+    """
+    rng = random.Random(seed)
+    names = ['node-%d' % n for n in range(nodes)]
+    out = ['<?xml version="1.0"?>\n<crm_mon version="1.1.15">\n<summary>\n'
+           '<last_update time="%s" />\n'
+           '<nodes_configured number="%d" expected_votes="unknown" />\n'
+           '<cluster_options stonith-enabled="%s" symmetric-cluster="true"'
+           ' no-quorum-policy="stop" maintenance-mode="%s" />\n'
+           '</summary>\n<nodes>\n' %
+           (LAST_UPDATE, configured or nodes, str(stonith).lower(),
+            str(maintenance).lower())]
+
+    for name in names:
+        state = dict(online='true', standby='false', maintenance='false',
+                     unclean='false')
+        if chance(rng, failures / 2):
+            fault = pick(rng, ['offline', 'standby', 'maintenance',
+                               'unclean'])
+            if fault == 'offline':
+                state['online'] = 'false'
+            else:
+                state[fault] = 'true'
+        out.append('<node name="%s" id="%s" online="%s" standby="%s"'
+                   ' maintenance="%s" pending="false" unclean="%s"'
+                   ' shutdown="false" type="member" />\n' %
+                   (name, name[5:], state['online'], state['standby'],
+                    state['maintenance'], state['unclean']))
+    out.append('</nodes>\n<resources>\n')
+
+    def primitive(rid, agent, node):
+        attrs = dict(role='Started', active='true', managed='true',
+                     failed='false', failure_ignored='false')
+        if chance(rng, failures):
+            fault = pick(rng, ['role', 'failed', 'managed', 'active'])
+            attrs[fault] = {'role': 'Stopped', 'failed': 'true',
+                            'managed': 'false', 'active': 'false'}[fault]
+        body = '' if attrs['role'] == 'Stopped' else \
+            '<node name="%s" id="%s" cached="false"/>' % (node, node[5:])
+        return ('<resource id="%s" resource_agent="%s" role="%s"'
+                ' active="%s" orphaned="false" managed="%s" failed="%s"'
+                ' failure_ignored="%s" nodes_running_on="1">%s</resource>\n' %
+                (rid, agent, attrs['role'], attrs['active'], attrs['managed'],
+                 attrs['failed'], attrs['failure_ignored'], body))
+
+    placed = []
+    if fencing:
+        for n, name in enumerate(names):
+            rid = 'stonith-%s' % name
+            out.append(primitive(rid, 'stonith:fence_ipmilan',
+                                 names[(n + 1) % nodes]))
+            placed.append((rid, names[(n + 1) % nodes]))
+    for p in range(primitives):
+        rid = 'prim-%d' % p
+        out.append(primitive(rid, 'ocf::heartbeat:IPaddr2', names[p % nodes]))
+        placed.append((rid, names[p % nodes]))
+    for c in range(clones):
+        failed = 'true' if chance(rng, failures / 2) else 'false'
+        out.append('<clone id="clone-%d" multi_state="false" unique="false"'
+                   ' managed="true" failed="%s" failure_ignored="false">\n' %
+                   (c, failed))
+        for name in names:
+            out.append(primitive('cloned-%d' % c, 'systemd:svc-%d' % c, name))
+            placed.append(('cloned-%d' % c, name))
+        out.append('</clone>\n')
+    out.append('</resources>\n<node_history>\n')
+
+    for name in names:
+        out.append('<node name="%s">\n' % name)
+        for rid, node in placed:
+            if node != name:
+                continue
+            out.append('<resource_history id="%s" orphan="false"'
+                       ' migration-threshold="1000000">\n' % rid)
+            for call in range(ops):
+                rc = pick(rng, [1, 7]) if chance(rng, failures / 4) else 0
+                out.append('<operation_history call="%d" task="%s"'
+                           ' last-rc-change="%d" exec-time="10ms"'
+                           ' queue-time="0ms" rc="%d" />\n' %
+                           (call, 'start' if call == 0 else 'monitor',
+                            1792400000 + call * 60, rc))
+            out.append('</resource_history>\n')
+        out.append('</node>\n')
+    out.append('</node_history>\n</crm_mon>\n')
+    return ''.join(out)
+
+
+def load_checker():
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('checker', CHECKER)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    except ImportError:
+        import imp
+        module = imp.load_source('checker', CHECKER)
+    module.LOG.addHandler(logging.NullHandler())
+    return module
+
+
+def warning_level(case):
+    return dict(case, messages=[['WARNING' if level == 'Warning' else level,
+                                 message]
+                                for level, message in case['messages']])
+
+
+# Intended differences to the baseline checker: case pattern,
+# reason and how the baseline result changes, None when it says
+# nothing about the current one and the case is recorded from
+# the current checker. The first matching entry applies.
+KNOWN_DIFFERENCES = [
+    ('*/regex', 'The baseline has no --resource-regex', None),
+    ('*/watermark*', 'The baseline has no --history-state', None),
+    ('maintenance/*', 'Maintenance mode is logged at WARNING, the'
+     ' baseline printed "Warning:"', warning_level),
+    ('failures-*/history', 'The baseline raised KeyError on any failed'
+     ' operation, it looked up OCF return codes by string', None),
+    ('failures-*/all', 'The baseline raised KeyError on any failed'
+     ' operation, it looked up OCF return codes by string', None),
+    ('*/resources', 'Every --resource is checked, the baseline only'
+     ' checked the last one', None),
+]
+
+
+def known_difference(key):
+    for pattern, reason, change in KNOWN_DIFFERENCES:
+        if fnmatch.fnmatchcase(key, pattern):
+            return reason, change
+    return None, None
+
+
+def run_scenarios(checker):
+    """ {scenario/options: {rc, messages}} for all scenarios """
+    results = {}
+    for scenario, kwargs in SCENARIOS:
+        model = checker.parse_crm_xml(generate_crm_xml(**kwargs))
+        tmp = tempfile.mkdtemp(prefix='pacemaker-scenario-')
+        try:
+            for options, argv in OPTION_SETS:
+                args = checker.parse_args(
+                    scenario_argv(argv, os.path.join(tmp, 'state')))
+                rc, messages = checker.merge_checks(
+                    checker.run_checks(model, args))
+                results['%s/%s' % (scenario, options)] = {
+                    'rc': rc,
+                    'messages': [[logging.getLevelName(level), msg]
+                                 for level, msg in messages]}
+        finally:
+            shutil.rmtree(tmp)
+    return results
+
+
+def run_baseline(python, revision):
+    """ {scenario/options: {rc, messages}} of the checker at git
+        revision, run by `python` with stand-ins for crm_mon and
+        pcs. Cases it fails on get {rc, error} instead.
+    """
+    source = subprocess.check_output(
+        ['git', 'show', '%s:%s' % (revision, os.path.basename(CHECKER))],
+        cwd=HERE)
+    tmp = tempfile.mkdtemp(prefix='pacemaker-baseline-')
+    try:
+        checker = os.path.join(tmp, os.path.basename(CHECKER))
+        crm_xml = os.path.join(tmp, 'crm_mon.xml')
+        crm_mon = os.path.join(tmp, 'crm_mon')
+        pcs = os.path.join(tmp, 'pcs')
+        with open(checker, 'wb') as f:
+            f.write(source)
+        with open(crm_mon, 'w') as f:
+            f.write('#!/bin/sh\ncat %s\n' % crm_xml)
+        os.chmod(crm_mon, 0o755)
+
+        results = {}
+        for scenario, kwargs in SCENARIOS:
+            with open(crm_xml, 'w') as f:
+                f.write(generate_crm_xml(**kwargs))
+            with open(pcs, 'w') as f:
+                f.write('#!/bin/sh\necho " maintenance-mode: %s"\n' %
+                        str(kwargs.get('maintenance', False)).lower())
+            os.chmod(pcs, 0o755)
+            state = os.path.join(tmp, 'state')
+            if os.path.exists(state):
+                os.remove(state)
+            for options, argv in OPTION_SETS:
+                # Relative, errors quoting it do not vary between runs
+                proc = subprocess.Popen(
+                    [python, checker, '--crm_mon', crm_mon, '--pcs', pcs] +
+                    scenario_argv(argv, 'state'), cwd=tmp,
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                stdout, stderr = proc.communicate()
+                key = '%s/%s' % (scenario, options)
+                if stderr.strip():
+                    results[key] = {'rc': proc.returncode,
+                                    'error': stderr.decode().strip()
+                                    .splitlines()[-1]}
+                    continue
+                results[key] = {
+                    'rc': proc.returncode,
+                    'messages': [line.split(': ', 1) for line in
+                                 stdout.decode().splitlines()]}
+        return results
+    finally:
+        shutil.rmtree(tmp)
+
+
+def record(path, python, revision):
+    """ Golden file with the results of the checker at revision,
+        and of the current one where KNOWN_DIFFERENCES say the
+        baseline result does not apply
+    """
+    cases = run_baseline(python, revision)
+    current = {}
+    for key, result in run_scenarios(load_checker()).items():
+        reason, change = known_difference(key)
+        if reason and change is None:
+            current[key] = result
+    with open(path, 'w') as f:
+        json.dump({'baseline': revision, 'cases': cases, 'current': current},
+                  f, indent=1, sort_keys=True, separators=(',', ': '))
+        f.write('\n')
+
+
+def verify(checker, path):
+    with open(path) as f:
+        golden = json.load(f)
+    cases = golden['cases']
+    current = run_scenarios(checker)
+    failed = 0
+    known = {}
+    for key in sorted(set(cases) | set(current)):
+        want, got = cases.get(key), current.get(key)
+        reason, change = known_difference(key)
+        if reason:
+            if change is None:
+                reason += ', recorded from the current checker'
+                want = golden['current'].get(key)
+            elif want is not None and 'error' not in want:
+                want = change(want)
+            known[reason] = known.get(reason, 0) + 1
+        if want == got:
+            continue
+        failed += 1
+        sys.stderr.write("MISMATCH %s\n  expected: %s\n  got:      %s\n" %
+                         (key, json.dumps(want), json.dumps(got)))
+    for reason, count in sorted(known.items()):
+        sys.stderr.write("KNOWN %d cases: %s\n" % (count, reason))
+    sys.stderr.write("%d/%d cases match %s recorded from %s\n" %
+                     (len(current) - failed, len(current), path,
+                      golden['baseline']))
+    return 1 if failed else 0
+
+
+def measure(size, opts, queue):
+    """ Runs in a child process so ru_maxrss is per size """
+    checker = load_checker()
+    xml = generate_crm_xml(nodes=size, primitives=size * 4,
+                           clones=opts.clones, ops=opts.ops,
+                           failures=opts.failures, seed=size)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    args = checker.parse_args(['--history', '--stonith'])
+    parse, evaluate = [], []
+    for _ in range(opts.repeat):
+        start = time.time()
+        model = checker.parse_crm_xml(xml)
+        parse.append(time.time() - start)
+        start = time.time()
+        rc, __ = checker.merge_checks(checker.run_checks(model, args))
+        evaluate.append(time.time() - start)
+        del model
+    queue.put({'nodes': size,
+               'resources': size * 5 + opts.clones * size,
+               'operations': (size * 5 + opts.clones * size) * opts.ops,
+               'xml_bytes': len(xml),
+               'parse_min': min(parse),
+               'parse_median': sorted(parse)[len(parse) // 2],
+               'evaluate_min': min(evaluate),
+               'evaluate_median': sorted(evaluate)[len(evaluate) // 2],
+               'rc': rc,
+               'baseline_rss_kb': baseline,
+               'peak_rss_kb': resource.getrusage(
+                   resource.RUSAGE_SELF).ru_maxrss})
+
+
+def benchmark(opts):
+    results = []
+    for size in opts.sizes:
+        queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=measure,
+                                       args=(size, opts, queue))
+        proc.start()
+        results.append(queue.get())
+        proc.join()
+        sys.stderr.write("%(nodes)d nodes: parse %(parse_median).3fs"
+                         " evaluate %(evaluate_median).3fs"
+                         " peak %(peak_rss_kb)d KB\n" % results[-1])
+    return results
+
+
+def git_version():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], cwd=HERE,
+            stderr=subprocess.STDOUT).decode().strip()
+    except Exception:
+        return None
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark and verify check-pacemaker-cluster.py')
+
+    parser.add_argument('--generate', metavar='nodes', type=int,
+                        help='Print a generated crm_mon document and exit')
+
+    parser.add_argument('--failures', metavar='p', type=float, default=0.0,
+                        help='Failure probability per injection point.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--sizes', metavar='list', type=int_list,
+                        default=[10, 50, 200, 800],
+                        help='Node counts to benchmark, each with 4'
+                             ' primitives per node. Default: 10,50,200,800')
+
+    parser.add_argument('--clones', metavar='int', type=int, default=10,
+                        help='Clones, with one instance per node.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--ops', metavar='int', type=int, default=10,
+                        help='History entries per resource and node.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--repeat', metavar='int', type=int, default=3,
+                        help='Repetitions per size. Default: %(default)s')
+
+    parser.add_argument('--verify', metavar='file', nargs='?', const=GOLDEN,
+                        help='Only run the correctness suite against a golden'
+                             ' file. Default: %s' % os.path.basename(GOLDEN))
+
+    parser.add_argument('--record', metavar='file', nargs='?', const=GOLDEN,
+                        help='Record the behaviour of the --baseline checker'
+                             ' as golden file')
+
+    parser.add_argument('--baseline', metavar='rev', type=str,
+                        help='Git revision or tag of the checker to record'
+                             ' with --record, the one before the changes'
+                             ' to verify')
+
+    parser.add_argument('--python', metavar='bin', default='python2',
+                        help='Interpreter for the baseline checker, which'
+                             ' needs Python 2. Default: %(default)s')
+
+    parser.add_argument('--output', '-o', metavar='file', type=str,
+                        help='Write JSON results to file instead of stdout')
+
+    opts = parser.parse_args()
+    if opts.record and not opts.baseline:
+        parser.error('--record needs --baseline')
+    return opts
+
+
+def main():
+    opts = parse_args()
+
+    if opts.generate:
+        sys.stdout.write(generate_crm_xml(
+            nodes=opts.generate, primitives=opts.generate * 4,
+            clones=opts.clones, ops=opts.ops, failures=opts.failures))
+        return 0
+
+    if opts.record:
+        record(opts.record, opts.python, opts.baseline)
+        return 0
+
+    checker = load_checker()
+
+    rc = verify(checker, opts.verify or GOLDEN)
+    if opts.verify:
+        return rc
+
+    output = {'version': git_version(),
+              'python': platform.python_version(),
+              'correctness': 'pass' if rc == 0 else 'fail',
+              'clones': opts.clones,
+              'ops': opts.ops,
+              'failures': opts.failures,
+              'repeat': opts.repeat,
+              'timestamp': int(time.time()),
+              'results': benchmark(opts)}
+
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(output, indent=2, sort_keys=True))
+    return rc
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+""" Startup time budget of the scripts in this repository.
+    Runs each script on a path that must not need its client
+    libraries (--help, or failing on missing credentials or
+    arguments) and checks that it stays within the import time
+    budget and does not import any of the heavy modules. Uses
+    -X importtime where available (Python 3.7+), wall time
+    otherwise. Exits 1 when a script is over budget.
+"""
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Script, arguments, expected exit code (None: any failure)
+SCRIPTS = [
+    ('api_ansible.py', ['-h'], 0),
+    ('check-pacemaker-cluster.py', ['-h'], 0),
+    ('doDomainSnapshots.py', ['-h'], 0),
+    ('set-undercloud-hosts.py', ['-h'], 0),
+    # Fail on missing credentials or instackenv.json
+    ('clean-neutron-environment.py', [], None),
+    ('create_stonith.py', [], None),
+]
+
+# Modules no script may load before it needs them
+HEAVY_MODULES = ('ansible', 'libvirt', 'novaclient', 'neutronclient',
+                 'ironicclient', 'keystoneauth1')
+
+
+def git_version():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], cwd=HERE,
+            stderr=subprocess.STDOUT).decode().strip()
+    except Exception:
+        return None
+
+
+def has_importtime():
+    return sys.version_info >= (3, 7)
+
+
+def run(argv, env):
+    """ (exit code, wall seconds, {module: cumulative seconds}) """
+    command = [sys.executable]
+    if has_importtime():
+        command += ['-X', 'importtime']
+    start = time.time()
+    proc = subprocess.Popen(command + argv, cwd=HERE, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    __, stderr = proc.communicate()
+    wall = time.time() - start
+
+    modules = {}
+    for line in stderr.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            cumulative = int(fields[1]) / 1e6
+        except ValueError:
+            continue
+        name = fields[2].rstrip()
+        # Top level imports are not indented
+        modules[name.strip()] = (cumulative,
+                                 len(name) - len(name.lstrip()) == 1)
+    return proc.returncode, wall, modules
+
+
+def import_time(modules):
+    return sum(c for c, top in modules.values() if top)
+
+
+def measure(argv, env, repeat):
+    """ Median import (or wall) time over repeat runs """
+    runs = [run(argv, env) for __ in range(repeat)]
+    runs.sort(key=lambda r: import_time(r[2]) if has_importtime() else r[1])
+    return runs[len(runs) // 2]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Check the startup time budget of the scripts')
+
+    parser.add_argument('--budget', metavar='ms', type=float, default=150,
+                        help='Import time allowed per script on top of the'
+                             ' interpreter startup. Default: %(default)s')
+
+    parser.add_argument('--repeat', metavar='int', type=int, default=5,
+                        help='Runs per script. Default: %(default)s')
+
+    parser.add_argument('--output', '-o', metavar='file', type=str,
+                        help='Write JSON results to file instead of stdout')
+
+    return parser.parse_args()
+
+
+def main():
+    opts = parse_args()
+
+    # Scripts must fail on missing credentials before
+    # loading anything
+    env = dict((k, v) for k, v in os.environ.items()
+               if not k.startswith('OS_'))
+
+    __, base_wall, base_modules = measure(['-c', 'pass'], env, opts.repeat)
+    base = import_time(base_modules) if has_importtime() else base_wall
+
+    rc = 0
+    results = []
+    for script, argv, expected in SCRIPTS:
+        code, wall, modules = measure([script] + argv, env, opts.repeat)
+        spent = (import_time(modules) if has_importtime() else wall) - base
+        heavy = sorted(m for m in modules
+                       if m.split('.')[0] in HEAVY_MODULES)
+        problems = []
+        if spent * 1000 > opts.budget:
+            problems.append('over budget')
+        if heavy:
+            problems.append('imports %s' % ', '.join(heavy))
+        if code != expected and (expected is not None or code == 0):
+            problems.append('exited with %s' % code)
+        if problems:
+            rc = 1
+
+        results.append({'script': script, 'argv': argv, 'rc': code,
+                        'wall': wall, 'startup': spent, 'heavy': heavy,
+                        'ok': not problems})
+        sys.stderr.write("%-30s %7.1fms %s\n" % (
+            script, spent * 1000, '; '.join(problems) or 'ok'))
+
+    output = {'version': git_version(),
+              'python': platform.python_version(),
+              'measure': 'importtime' if has_importtime() else 'wall',
+              'baseline': base,
+              'budget': opts.budget / 1000,
+              'timestamp': int(time.time()),
+              'results': results}
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(output, indent=2, sort_keys=True))
+    return rc
+
+
+if __name__ == "__main__":
+    sys.exit(main())
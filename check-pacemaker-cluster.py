@@ -2,10 +2,26 @@
 import traceback
 import subprocess
 import argparse
+import fcntl
+import shlex
+import threading
 import logging
+import signal
+import socket
+import json
+import time
 import sys
+import io
 import os
 import re
+from collections import namedtuple
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
 
 try:
     import xml.etree.ElementTree as ET
@@ -22,6 +38,15 @@ except ImportError:
 
 LOG = logging.getLogger(__name__)
 
+# Check options a daemon query can carry
+QUERY_OPTIONS = ('resource', 'resource_regex', 'stonith', 'stonith_agent',
+                 'history', 'history_state', 'history_window', 'perfdata')
+
+NAGIOS_STATUS = {0: 'OK', 1: 'WARNING', 2: 'CRITICAL', 3: 'UNKNOWN'}
+
+# last-rc-change formats of the crm_mon versions around
+RC_CHANGE_FORMATS = ('%a %b %d %H:%M:%S %Y', '%Y-%m-%d %H:%M:%S')
+
 
 # Return codes for resource tasks
 # Source: clusterlabs.org/doc/en-US/Pacemaker/1.1/html/Pacemaker_Explained/s-ocf-return-codes.html  # noqa
@@ -39,58 +64,68 @@ OCF_RETURN_CODES = {
 }
 
 
-class CRMBaseObject(object):
+def _bool(attrib, key):
+    return attrib.get(key) == "true"
 
-    def __init__(self, xml_obj):
-        self.xml_obj = xml_obj
-        for k, v in xml_obj.attrib.iteritems():
-            setattr(self, k, v)
 
-    @classmethod
-    def get_instances(cls):
-        return list(cls.instances)
+class Node(namedtuple('Node', ['name', 'id', 'online', 'standby',
+                               'maintenance', 'unclean', 'history'])):
+    """ Cluster node. history is a tuple of ResourceHistory """
+    __slots__ = ()
 
     @classmethod
-    def count(cls):
-        return len(cls.instances)
-
+    def from_attrib(cls, attrib, history=()):
+        return cls(attrib['name'], attrib.get('id'),
+                   _bool(attrib, 'online'), _bool(attrib, 'standby'),
+                   _bool(attrib, 'maintenance'), _bool(attrib, 'unclean'),
+                   tuple(history))
 
-class Resources(CRMBaseObject):
-    instances = []
 
-    def __init__(self, obj):
-        CRMBaseObject.__init__(self, obj)
-        Resources.instances.append(self)
+class Resource(namedtuple('Resource', ['id', 'resource_agent', 'role',
+                                       'active', 'managed', 'failed',
+                                       'failure_ignored', 'node'])):
+    """ Primitive resource, node is the first node it runs on """
+    __slots__ = ()
 
     @classmethod
-    def clean(cls):
-        del cls.instances[:]
+    def from_attrib(cls, attrib, node=None):
+        return cls(attrib['id'], attrib.get('resource_agent'),
+                   attrib.get('role'), _bool(attrib, 'active'),
+                   _bool(attrib, 'managed'), _bool(attrib, 'failed'),
+                   _bool(attrib, 'failure_ignored'), node)
 
 
-class Clones(CRMBaseObject):
-    instances = []
+class Clone(namedtuple('Clone', ['id', 'managed', 'failed',
+                                 'failure_ignored', 'resources'])):
+    """ Clone resource, resources is a tuple of Resource """
+    __slots__ = ()
+
+    @classmethod
+    def from_attrib(cls, attrib, resources=()):
+        return cls(attrib['id'], _bool(attrib, 'managed'),
+                   _bool(attrib, 'failed'), _bool(attrib, 'failure_ignored'),
+                   tuple(resources))
 
-    def __init__(self, obj):
-        CRMBaseObject.__init__(self, obj)
-        Clones.instances.append(self)
 
+ResourceHistory = namedtuple('ResourceHistory', ['id', 'operations'])
 
-class Nodes(CRMBaseObject):
-    instances = []
+Operation = namedtuple('Operation', ['call', 'task', 'rc',
+                                     'last_rc_change'])
 
-    def __init__(self, obj):
-        CRMBaseObject.__init__(self, obj)
-        Nodes.instances.append(self)
 
-    def set_history(self, obj):
-        self.history = obj
+class CRMError(Exception):
+    pass
 
-    @property
-    def get_history(self):
-        return self.history
 
+class ClusterModel(namedtuple('ClusterModel', [
+        'last_update', 'nodes_configured', 'cluster_options', 'nodes',
+        'resources', 'clones', 'node_index', 'resource_index',
+        'clone_index'])):
+    """ Immutable snapshot of one crm_mon run """
+    __slots__ = ()
 
-def parse_args():
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(
         description='Check Pacemaker cluster')
 
@@ -99,16 +134,45 @@ def parse_args():
                         help='crm_mon binary. Defaults to '
                              '/sbin/crm_mon')
 
+    parser.add_argument('--cibadmin', metavar='bin', type=str,
+                        default='/sbin/cibadmin',
+                        help='cibadmin binary, only used when crm_mon does'
+                             ' not report maintenance-mode. Defaults to'
+                             ' /sbin/cibadmin')
+
     parser.add_argument('--pcs', metavar='bin', type=str,
-                        default='/sbin/pcs',
-                        help='pcs binary, defaults to '
-                             '/sbin/pcs')
+                        help='Deprecated, ignored. Cluster properties are'
+                             ' read from crm_mon')
 
     parser.add_argument('--debug', '-d', action='store_true',
                         help='Debug output')
 
     parser.add_argument('--resource', metavar='name', type=str,
-                        help='Check for specific resource')
+                        action='append',
+                        help='Check for specific resource. Can be repeated')
+
+    parser.add_argument('--resource-regex', metavar='regex', type=str,
+                        help='Check all resources with a matching id')
+
+    parser.add_argument('--resource-file', metavar='file', type=str,
+                        help='Check the resources listed in file,'
+                             ' one id per line')
+
+    parser.add_argument('--history-state', metavar='file', type=str,
+                        help='With --history, remember the newest operation'
+                             ' seen per node, resource and task in file and'
+                             ' only report failures that are new since the'
+                             ' previous run')
+
+    parser.add_argument('--history-window', metavar='sec', type=float,
+                        default=86400,
+                        help='Window for per resource failure counts kept in'
+                             ' --history-state. Default: %(default)s')
+
+    parser.add_argument('--output', choices=('text', 'json'),
+                        default='text',
+                        help='Output format. json prints one status per'
+                             ' check. Default: %(default)s')
 
     parser.add_argument('--stonith', action='store_true',
                         help='Check stonith enable')
@@ -122,40 +186,329 @@ def parse_args():
     parser.add_argument('--history', action='store_true',
                         help='Check past resource events')
 
-    return parser.parse_args()
+    parser.add_argument('--perfdata', action='store_true',
+                        help='Add Nagios performance data: node, resource,'
+                             ' stonith and history failure counts and the'
+                             ' time taken by crm_mon, parsing and checks')
+
+    parser.add_argument('--cache', metavar='file', type=str,
+                        help='Share crm_mon output between concurrent checks'
+                             ' through this file. Checks started within'
+                             ' --cache-ttl of each other use one crm_mon run')
+
+    parser.add_argument('--cache-ttl', metavar='sec', type=float, default=30,
+                        help='Maximum age of the --cache file.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--xml', metavar='source', type=str,
+                        help='Check recorded crm_mon -X output instead of'
+                             ' running crm_mon: a file, - for stdin, or a'
+                             ' directory of *.xml snapshots to evaluate in'
+                             ' parallel into a health timeline')
+
+    parser.add_argument('--workers', metavar='int', type=int,
+                        help='Processes for evaluating a --xml directory'
+                             ' or --cluster entries. Default: number of'
+                             ' CPUs')
+
+    parser.add_argument('--cluster', metavar='name=transport:spec',
+                        action='append', dest='clusters', default=[],
+                        help='Check a cluster by fetching its crm_mon XML'
+                             ' through a transport: local:, ssh:HOST,'
+                             ' cmd:COMMAND or file:PATH. Can be repeated')
+
+    parser.add_argument('--clusters-file', metavar='file', type=str,
+                        help='File with one name=transport:spec per line')
+
+    parser.add_argument('--ssh-command', metavar='template', type=str,
+                        default='ssh -o BatchMode=yes -o ConnectTimeout=10'
+                                ' {host} crm_mon -r -1 -X',
+                        help='Command for the ssh transport, {host} is'
+                             ' replaced. Default: %(default)s')
+
+    parser.add_argument('--parallel', metavar='int', type=int, default=8,
+                        help='Clusters fetched at the same time.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--fetch-timeout', metavar='sec', type=float,
+                        default=30,
+                        help='Time limit for fetching one cluster status.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--socket', metavar='path', type=str,
+                        help='Unix socket of a running --daemon. Checks are'
+                             ' answered by the daemon, falling back to'
+                             ' running crm_mon if it is not available')
+
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep a parsed cluster status up to date and'
+                             ' answer check queries on --socket')
+
+    parser.add_argument('--refresh', metavar='sec', type=float, default=10,
+                        help='Daemon status refresh interval. A SIGHUP, e.g.'
+                             ' from a crm_mon external agent (crm_mon -E),'
+                             ' refreshes immediately. Default: %(default)s')
+
+    parser.add_argument('--max-age', metavar='sec', type=float, default=60,
+                        help='Oldest daemon status a client accepts before'
+                             ' falling back to one-shot mode.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--pidfile', metavar='file', type=str,
+                        help='Write the daemon pid to file')
+
+    args = parser.parse_args(argv)
+    if args.daemon and not args.socket:
+        parser.error('--daemon requires --socket')
+    if args.clusters_file:
+        try:
+            with open(args.clusters_file) as f:
+                args.clusters.extend(
+                    line.strip() for line in f
+                    if line.strip() and not line.startswith('#'))
+        except IOError as e:
+            parser.error('Cannot read %s: %s' % (args.clusters_file, e))
+    names = set()
+    for cluster in args.clusters:
+        name, sep, spec = cluster.partition('=')
+        if not sep or spec.split(':', 1)[0] not in TRANSPORTS:
+            parser.error('Invalid cluster %s, expected name=%s:spec' %
+                         (cluster, '|'.join(sorted(TRANSPORTS))))
+        if name in names:
+            parser.error('Duplicate cluster name %s' % name)
+        names.add(name)
+    if args.resource_file:
+        try:
+            with open(args.resource_file) as f:
+                args.resource = (args.resource or []) + [
+                    line.strip() for line in f
+                    if line.strip() and not line.startswith('#')]
+        except IOError as e:
+            parser.error('Cannot read %s: %s' % (args.resource_file, e))
+    return args
 
 
-def get_crm_output(binary):
+def get_crm_xml(binary):
     try:
         crm = subprocess.Popen([binary, '-r', '-1', '-X'],
                                stdout=subprocess.PIPE)
     except OSError as e:
-        sys.stderr.write("Error: %s" % e)
-        sys.exit(2)
+        raise CRMError(e)
 
     stdout, __ = crm.communicate()
+    if crm.returncode != 0 and not stdout.strip():
+        raise CRMError("%s exited with %d" % (binary, crm.returncode))
+    return stdout
+
+
+def get_cached_crm_xml(binary, path, ttl):
+    """ crm_mon output shared between concurrent invocations.
+        A fresh cache is read under a shared lock. Callers that
+        find it expired take an exclusive lock, check again and
+        only the first of them runs crm_mon; the others then read
+        the fresh file. Returns (xml, age).
+    """
+    def read_fresh():
+        try:
+            age = time.time() - os.stat(path).st_mtime
+            if 0 <= age < ttl:
+                with open(path, 'rb') as f:
+                    return f.read(), age
+        except (IOError, OSError):
+            pass
+        return None
+
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        cached = read_fresh()
+        if cached is not None:
+            return cached
+
+        # Not atomic, another caller may refresh the cache while
+        # this one waits for the exclusive lock
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        cached = read_fresh()
+        if cached is not None:
+            return cached
+
+        stdout = get_crm_xml(binary)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(stdout)
+        os.rename(tmp, path)
+        return stdout, 0.0
+
+
+def get_crm_output(binary, xml=None, stats=None):
+    """ Parsed crm_mon output. Fetch and parse times and the
+        XML size are recorded in the stats dict if given.
+    """
+    stats = {} if stats is None else stats
+    if xml is None:
+        start = time.time()
+        xml = get_crm_xml(binary)
+        stats['fetch_time'] = time.time() - start
+
+    stats['xml_size'] = len(xml)
+    start = time.time()
+    try:
+        model = parse_crm_xml(xml)
+    except Exception as e:
+        raise CRMError("Error parsing XML output: %s" % e)
+
+    stats['parse_time'] = time.time() - start
+    return model
+
+
+def parse_crm_xml(source):
+    """ Parse crm_mon -X output in a single streaming pass.
+        `source` is a file object or a string with the XML.
+        Returns a ClusterModel of Node, Resource and Clone
+        records, with node history attached to each Node and
+        indexes keyed by node name and resource/clone id.
+        Elements are cleared once recorded so memory does
+        not grow with the size of the operation history.
+    """
+    if not hasattr(source, 'read'):
+        if not isinstance(source, bytes):
+            source = source.encode('utf-8')
+        source = io.BytesIO(source)
+
+    last_update = None
+    nodes_configured = None
+    cluster_options = {}
+    node_attribs = []
+    resources = []
+    clones = []
+    history = {}
+    path = []
+    parents = []
+    clone = None
+    clone_resources = None
+    primitive = None
+    primitive_node = None
+    history_name = None
+    history_resource = None
+
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            path.append(elem.tag)
+            parents.append(elem)
+            depth = len(path)
+            section = path[1] if depth > 1 else None
+            if section == 'resources':
+                if depth == 3 and elem.tag == 'clone':
+                    clone = dict(elem.attrib)
+                    clone_resources = []
+                elif elem.tag == 'resource' and (
+                        depth == 3 or (depth == 4 and clone is not None)):
+                    primitive = dict(elem.attrib)
+                    primitive_node = None
+                elif elem.tag == 'node' and primitive is not None \
+                        and primitive_node is None:
+                    primitive_node = elem.attrib.get('name')
+            elif section == 'node_history':
+                if depth == 3 and elem.tag == 'node':
+                    history_name = elem.attrib['name']
+                    history.setdefault(history_name, [])
+                elif depth == 4 and elem.tag == 'resource_history':
+                    history_resource = (elem.attrib['id'], [])
+                elif depth == 5 and elem.tag == 'operation_history':
+                    attrib = elem.attrib
+                    history_resource[1].append(Operation(
+                        attrib.get('call'), attrib.get('task'),
+                        int(attrib.get('rc', 0)),
+                        attrib.get('last-rc-change')))
+            continue
+
+        depth = len(path)
+        section = path[1] if depth > 1 else None
+        path.pop()
+        parents.pop()
+        if section == 'summary':
+            if elem.tag == 'last_update':
+                last_update = elem.attrib.get('time')
+            elif elem.tag == 'nodes_configured':
+                nodes_configured = int(elem.attrib['number'])
+            elif elem.tag == 'cluster_options':
+                cluster_options = dict(elem.attrib)
+        elif section == 'nodes' and depth == 3 and elem.tag == 'node':
+            node_attribs.append(dict(elem.attrib))
+        elif section == 'resources':
+            if elem.tag == 'resource' and primitive is not None:
+                record = Resource.from_attrib(primitive, primitive_node)
+                if depth == 3:
+                    resources.append(record)
+                    LOG.debug('Resource record: %s', record)
+                elif depth == 4:
+                    clone_resources.append(record)
+                primitive = None
+            elif depth == 3 and elem.tag == 'clone':
+                record = Clone.from_attrib(clone, clone_resources)
+                clones.append(record)
+                LOG.debug('Clone record: %s', record)
+                clone = None
+        elif section == 'node_history' and depth == 4 \
+                and history_resource is not None:
+            history[history_name].append(
+                ResourceHistory(history_resource[0],
+                                tuple(history_resource[1])))
+            history_resource = None
+
+        # Drop parsed elements, keep only the records.
+        # Events are queued ahead of the parser, but any
+        # element still pending keeps its own attributes
+        # when its parent is cleared.
+        if depth >= 3:
+            elem.clear()
+            parents[-1].clear()
+
+    nodes = []
+    for attrib in node_attribs:
+        record = Node.from_attrib(attrib, history.get(attrib['name'], ()))
+        nodes.append(record)
+        LOG.debug('Node record: %s (%d resource histories)',
+                  record.name, len(record.history))
+
+    return ClusterModel(
+        last_update, nodes_configured, cluster_options, tuple(nodes),
+        tuple(resources), tuple(clones), dict((n.name, n) for n in nodes),
+        dict((r.id, r) for r in resources), dict((c.id, c) for c in clones))
+
+
+def get_crm_config(binary):
+    """ Cluster properties from the CIB crm_config section,
+        for crm_mon versions that do not report them.
+    """
+    try:
+        cib = subprocess.Popen([binary, '--query', '--scope', 'crm_config'],
+                               stdout=subprocess.PIPE)
+    except OSError as e:
+        raise CRMError(e)
+
+    stdout, __ = cib.communicate()
     try:
         root = ET.fromstring(stdout)
     except Exception as e:
-        sys.stderr.write("Error parsing XML output: %s" % e)
-        sys.exit(2)
+        raise CRMError("Error parsing cibadmin output: %s" % e)
 
-    return root
+    return dict((nv.attrib['name'], nv.attrib.get('value'))
+                for nv in root.iter('nvpair'))
 
 
-def check_maintenance(binary):
-    try:
-        crm = subprocess.Popen([binary + ' property|grep maintenance'],
-                               stdout=subprocess.PIPE, shell=True)
-    except OSError as e:
-        sys.stderr.write("Error: %s" % e)
-        sys.exit(2)
+def with_cluster_properties(model, cibadmin):
+    """ Make sure maintenance-mode is in the model cluster
+        options. crm_mon reports it with the other options, only
+        older versions need one extra cibadmin query.
+    """
+    if 'maintenance-mode' in model.cluster_options:
+        return model
 
-    stdout, __ = crm.communicate()
-    LOG.debug('Maintenance mode output: %s' % stdout.rstrip())
-    if re.match(r'.*maintenance-mode: true.*', stdout):
-        print "Warning: Cluster in maintenance mode!"
-        sys.exit(1)
+    LOG.debug('crm_mon did not report maintenance-mode, querying CIB')
+    properties = get_crm_config(cibadmin)
+    options = dict(model.cluster_options)
+    options['maintenance-mode'] = properties.get('maintenance-mode', 'false')
+    return model._replace(cluster_options=options)
 
 
 def set_logger(debug=False):
@@ -171,224 +524,948 @@ def set_logger(debug=False):
     LOG.debug('Set debug level')
 
 
-def check_cluster():
-    try:
-        args = parse_args()
-    except Exception as e:
-        sys.stderr.write("Error parsing arguments: %s\n" % e)
-        sys.exit(1)
-
-    if not os.path.exists(args.crm_mon):
-        sys.stderr.write("Error: %s not found\n" % args.crm_mon)
-        sys.exit(3)
-
-    if not os.path.exists(args.pcs):
-        sys.stderr.write("Error: %s not found\n" % args.pcs)
-        sys.exit(3)
-
-    set_logger(debug=args.debug)
-
-    # Check if maintenance mode is set for
-    # the entire cluster. Exit warning if so.
-    check_maintenance(args.pcs)
+class CheckResult(object):
+    """ Messages and return code of one check. Warnings raise
+        the return code to at least 1, errors to 2.
+    """
+    __slots__ = ('name', 'rc', 'messages', 'data')
+
+    def __init__(self, name, rc=0, messages=None, data=None):
+        self.name = name
+        self.rc = rc
+        self.messages = messages if messages is not None else []
+        self.data = data
+
+    def log(self, level, msg):
+        self.messages.append((level, msg))
+        if level >= logging.ERROR:
+            self.rc = 2
+        elif level >= logging.WARNING:
+            self.rc = max(self.rc, 1)
+
+    def as_dict(self):
+        result = {'name': self.name, 'rc': self.rc,
+                  'status': NAGIOS_STATUS[self.rc],
+                  'messages': [[logging.getLevelName(level), msg]
+                               for level, msg in self.messages]}
+        if self.data is not None:
+            result['data'] = self.data
+        return result
 
-    # Get XML output
-    try:
-        root = get_crm_output(args.crm_mon)
-    except:
-        sys.stderr.write(traceback.format_exc())
-        sys.exit(2)
-
-    # Sort data into objects
-    for obj in root.find('nodes').findall('node'):
-        LOG.debug('Creating Node instance: %s' % ET.tostring(obj))
-        Nodes(obj)
-
-    for obj in root.find('resources').findall('resource'):
-        LOG.debug('Creating Resource instance: %s' %
-                  ET.tostring(obj))
-        Resources(obj)
-
-    for obj in root.find('resources').findall('clone'):
-        LOG.debug('Creating Clone resource instance: %s' %
-                  ET.tostring(obj))
-        Clones(obj)
-
-    node_history = root.find('node_history')
-    for node in Nodes.get_instances():
-        obj = node_history.find(".node[@name='%s']" % node.name)
-        LOG.debug('Appending Node instance history: %s' %
-                  ET.tostring(obj))
-        node.set_history(obj)
-
-    rc = 0
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['name'], data['rc'],
+                   [(logging.getLevelName(level), msg)
+                    for level, msg in data['messages']],
+                   data.get('data'))
+
+
+class HistoryState(object):
+    """ Watermarks of the newest operation seen per node,
+        resource and task, and the failures seen within the
+        sliding window. Kept in a JSON file, locked while a
+        check reads and updates it.
+    """
+
+    def __init__(self, path, window):
+        self.path = path
+        self.window = window
+        self.lock = None
+        self.previous = {}
+        self.watermarks = {}
+        self.failures = []
+
+    def __enter__(self):
+        self.lock = open(self.path + '.lock', 'a')
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self.previous = dict((k, tuple(v)) for k, v in
+                                 data.get('watermarks', {}).items())
+            self.failures = data.get('failures', [])
+        except (IOError, ValueError) as e:
+            LOG.debug("No usable history state in %s: %s" % (self.path, e))
+        self.watermarks = dict(self.previous)
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            if exc[0] is None:
+                tmp = '%s.%d.tmp' % (self.path, os.getpid())
+                with open(tmp, 'w') as f:
+                    json.dump({'watermarks': self.watermarks,
+                               'failures': self.failures}, f)
+                os.rename(tmp, self.path)
+        finally:
+            self.lock.close()
+
+    def is_new(self, node, resource, task, mark):
+        """ True if mark is newer than the watermark of the
+            previous run. Tracks the newest mark for this run.
+        """
+        key = '%s\t%s\t%s' % (node, resource, task)
+        if mark > self.watermarks.get(key, (0, 0)):
+            self.watermarks[key] = mark
+        previous = self.previous.get(key)
+        return previous is None or mark > previous
+
+    def add_failure(self, when, node, resource, task, rc):
+        self.failures.append([when, node, resource, task, rc])
+
+    def failure_counts(self, now=None):
+        """ Failures per resource within the window. Older
+            failures are dropped from the state.
+        """
+        since = (now or time.time()) - self.window
+        self.failures = [f for f in self.failures if f[0] >= since]
+        counts = {}
+        for f in self.failures:
+            counts[f[2]] = counts.get(f[2], 0) + 1
+        return counts
+
+
+def check_node_count(model, result):
+    if model.nodes_configured > len(model.nodes):
+        result.log(logging.WARNING, "Missing nodes from configuration")
+
+
+def check_nodes(model, result):
+    node_count = len(model.nodes)
 
     # Check node count
-    summary = root.find('summary')
-    nodes_configured = summary.find('nodes_configured').attrib['number']
-    if int(nodes_configured) > Nodes.count():
-        LOG.warning("Missing nodes from configuration")
-        rc = 1
-
-    # Check stonith enabled
-    stonith = summary.find('cluster_options').attrib['stonith-enabled']
-    if stonith != "true" and args.stonith is True:
-        LOG.warning("Stonith disabled!")
-        rc = 1
+    check_node_count(model, result)
 
     # Check node status
     standby_nodes = 0
     maintenance_nodes = 0
-    stonith_nodes = 0
-    for node in Nodes.get_instances():
-        if args.resource:
-            continue
-
-        if node.maintenance == "true":
-            LOG.info("Node %s is in maintenance mode" % node.name)
+    for node in model.nodes:
+        if node.maintenance:
+            result.log(logging.INFO,
+                       "Node %s is in maintenance mode" % node.name)
             maintenance_nodes += 1
             continue
 
-        if node.standby == "true":
-            LOG.info("Node %s is in standby mode" % node.name)
+        if node.standby:
+            result.log(logging.INFO, "Node %s is in standby mode" % node.name)
             standby_nodes += 1
             continue
 
-        if node.online != "true":
-            LOG.error("Node %s is not online" % node.name)
-            rc = 2
+        if not node.online:
+            result.log(logging.ERROR, "Node %s is not online" % node.name)
             continue
 
-        if node.unclean == "true":
-            LOG.warning("Node %s unclean" % node.name)
-            rc = 1
+        if node.unclean:
+            result.log(logging.WARNING, "Node %s unclean" % node.name)
 
-        if not args.history:
-            continue
+    def percentage(part, whole):
+        return 100 * float(part)/float(whole)
 
-        rh_all = node.get_history.findall("resource_history")
-        for rh in rh_all:
-            opsh = rh.findall('operation_history')
-            for op in opsh:
-                if op.attrib['rc'] != "0" and op.attrib['rc'] != "8":
-                    LOG.warning("Node %s resource %s task"
-                          " %s had return code %s (%s)"
-                          " last seen at %s" %
-                          (node.name,
-                           rh.attrib['id'],
-                           op.attrib['task'],
-                           op.attrib['rc'],
-                           OCF_RETURN_CODES[op.attrib['rc']],
-                           op.attrib['last-rc-change']))
-                    if rc == 0:
-                        rc = 1
-
-    resource_found = False
-    for resource in Resources.get_instances():
-        if args.resource and args.resource != resource.id:
-            continue
+    perc_maint = percentage(maintenance_nodes, node_count)
+    perc_standby = percentage(standby_nodes, node_count)
+    if perc_maint > 50:
+        result.log(logging.WARNING, "More than half of the cluster nodes"
+                   " are in maintenance (%.1f)" % perc_maint)
+
+    if perc_standby > 50:
+        result.log(logging.WARNING, "More than half of the cluster nodes"
+                   " are in standby mode (%.1f)" % perc_standby)
 
-        resource_found = True
-        node = "N/A"
-        try:
-            node = resource.xml_obj.find('node').attrib['name']
-        except:
-            pass
 
-        if resource.active != "true" or resource.failure_ignored == "true":
+def active_nodes(model):
+    return [node for node in model.nodes
+            if not (node.maintenance or node.standby or not node.online)]
+
+
+def parse_rc_change(value):
+    """ Epoch seconds of a last-rc-change attribute, which
+        is either epoch seconds or a local time string.
+    """
+    if not value:
+        return None
+    value = value.strip("'\" ")
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in RC_CHANGE_FORMATS:
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
             continue
+    return None
+
+
+def check_history(model, result, state=None):
+    """ Report failed operations. With a HistoryState only
+        operations newer than the previous run are reported,
+        and per resource failure counts over the state window
+        are added to the result.
+    """
+    parsed = {}
+    now = time.time()
+    for node in active_nodes(model):
+        for rh in node.history:
+            for op in rh.operations:
+                when = None
+                if state is not None:
+                    if op.last_rc_change not in parsed:
+                        parsed[op.last_rc_change] = \
+                            parse_rc_change(op.last_rc_change)
+                    when = parsed[op.last_rc_change]
+                    call = int(op.call) if op.call and \
+                        op.call.lstrip('-').isdigit() else 0
+                    if not state.is_new(node.name, rh.id, op.task,
+                                        (when or 0, call)):
+                        continue
+
+                if op.rc != 0 and op.rc != 8:
+                    result.log(logging.WARNING,
+                               "Node %s resource %s task"
+                               " %s had return code %s (%s)"
+                               " last seen at %s" %
+                               (node.name, rh.id, op.task, op.rc,
+                                OCF_RETURN_CODES.get(op.rc, 'UNKNOWN'),
+                                op.last_rc_change))
+                    if state is not None:
+                        state.add_failure(when or now, node.name, rh.id,
+                                          op.task, op.rc)
+
+    if state is None:
+        return
+
+    counts = state.failure_counts(now)
+    hours = state.window / 3600.0
+    for resource, count in sorted(counts.items(),
+                                  key=lambda i: (-i[1], i[0])):
+        result.log(logging.INFO, "Resource %s failed %d times in the last"
+                   " %.1fh (%.2f/h)" % (resource, count, hours,
+                                        count / hours))
+    result.data = {'window': state.window, 'failures': counts,
+                   'failure_rate': dict((r, c / hours)
+                                        for r, c in counts.items())}
+
+
+def check_stonith(model, result, agent):
+    # Check stonith enabled
+    if model.cluster_options.get('stonith-enabled') != "true":
+        result.log(logging.WARNING, "Stonith disabled!")
 
-        if resource.role != "Started":
-            LOG.error("Resource '%s' not Started on node %s" %
-                      (resource.id, node))
-            rc = 2
+    if not agent:
+        return
 
-        if resource.failed == "true":
-            LOG.error("Resource '%s' failed on node %s" %
-                      (resource.id, node))
-            rc = 2
+    node_count = len(model.nodes)
+    stonith_nodes = len([r for r in model.resources
+                         if r.active and not r.failure_ignored and
+                         r.resource_agent == agent])
+    if stonith_nodes < node_count:
+        if stonith_nodes == 0:
+            result.log(logging.WARNING, "No stonith nodes")
+        else:
+            result.log(logging.WARNING,
+                       "%s stonith nodes configured out of %s nodes" %
+                       (stonith_nodes, node_count))
 
-        if resource.managed == "false":
-            LOG.warning("Resource '%s' not managed on node %s" %
-                  (resource.id, node))
-            if rc == 0:
-                rc = 1
 
-        if args.resource:
-            LOG.info("Resource %s started on %s" % (resource.id, node))
+def check_primitive(resource, result, verbose=False):
+    node = resource.node or "N/A"
 
-        if resource.resource_agent == args.stonith_agent:
-            stonith_nodes += 1
+    if not resource.active or resource.failure_ignored:
+        return
 
-    for clone in Clones.get_instances():
-        if args.resource and args.resource != clone.id:
+    if resource.role != "Started":
+        result.log(logging.ERROR, "Resource '%s' not Started on node %s" %
+                   (resource.id, node))
+
+    if resource.failed:
+        result.log(logging.ERROR, "Resource '%s' failed on node %s" %
+                   (resource.id, node))
+
+    if not resource.managed:
+        result.log(logging.WARNING, "Resource '%s' not managed on node %s" %
+                   (resource.id, node))
+
+    if verbose:
+        result.log(logging.INFO, "Resource %s started on %s" %
+                   (resource.id, node))
+
+
+def check_clone(clone, result, verbose=False):
+    if clone.failed and clone.failure_ignored:
+        result.log(logging.ERROR, "Clone '%s' failed" % clone.id)
+
+    for r in clone.resources:
+        if r.role == "Stopped":
+            result.log(logging.ERROR, "Clone resource is stopped: %s" % r.id)
+            continue
+
+        node = r.node or "N/A"
+        if not r.active or r.failure_ignored:
             continue
 
-        resource_found = True
-        if clone.failed == "true" and clone.failure_ignored != "false":
-            rc = 2
-            LOG.error("Clone '%s' on node %s failed" % (clone.id, node))
-
-        Resources.clean()
-        for obj in clone.xml_obj.findall('resource'):
-            r = Resources(obj)
-            if r.role == "Stopped":
-                LOG.error("Clone resource is stopped: %s" % r.id)
-                rc = 2
-                continue
-
-            node = r.xml_obj.find('node').attrib['name']
-            if r.active != "true" or r.failure_ignored == "true":
-                continue
-
-            if r.failed == "true":
-                LOG.error("Clone '%s' resource '%s' failed on node %s" %
-                          (clone.id, r.id, node))
-                rc = 2
-
-            if clone.managed == "false":
-                LOG.warning("Clone '%s' resource '%s' not managed "
-                            "on node %s" %
-                            (clone.id, r.id, node))
-                if rc == 0:
-                    rc = 1
-
-            if args.resource:
-               LOG.info("Resource clone %s started on %s" % (r.id, node))
-
-    if args.stonith and args.stonith_agent:
-        if stonith_nodes < Nodes.count():
-            if stonith_nodes == 0:
-                LOG.warning("No stonith nodes")
+        if r.failed:
+            result.log(logging.ERROR,
+                       "Clone '%s' resource '%s' failed on node %s" %
+                       (clone.id, r.id, node))
+
+        if not clone.managed:
+            result.log(logging.WARNING, "Clone '%s' resource '%s' not"
+                       " managed on node %s" % (clone.id, r.id, node))
+
+        if verbose:
+            result.log(logging.INFO, "Resource clone %s started on %s" %
+                       (r.id, node))
+
+
+def check_resource(model, result, resource_id):
+    """ Check one resource or clone by id """
+    if resource_id in model.resource_index:
+        check_primitive(model.resource_index[resource_id], result,
+                        verbose=True)
+    elif resource_id in model.clone_index:
+        check_clone(model.clone_index[resource_id], result, verbose=True)
+    else:
+        result.log(logging.ERROR, "Did not find resource %s" % resource_id)
+
+
+def check_resources(model, result):
+    """ Check all resources and clones """
+    for resource in model.resources:
+        check_primitive(resource, result)
+
+    for clone in model.clones:
+        check_clone(clone, result)
+
+
+def selected_resources(model, args):
+    """ Resource ids requested with --resource, --resource-file
+        and --resource-regex, in order and without duplicates.
+        Returns None if no resource selection was made.
+    """
+    ids = list(args.resource or [])
+    if getattr(args, 'resource_regex', None):
+        regex = re.compile(args.resource_regex)
+        ids.extend(sorted(i for i in list(model.resource_index) +
+                          list(model.clone_index) if regex.search(i)))
+    if not ids and not getattr(args, 'resource_regex', None):
+        return None
+
+    seen = set()
+    return [i for i in ids if not (i in seen or seen.add(i))]
+
+
+def run_checks(model, args):
+    """ Run the checks selected in args against a ClusterModel.
+        Returns a list of CheckResult, one per check: nodes,
+        history, stonith and resources. When resources were
+        selected there is one per selected resource instead, and
+        the nodes check only compares the node count with the
+        configuration, as it did before resources could be
+        selected.
+    """
+    # Maintenance mode for the entire cluster
+    # overrides all other checks
+    if model.cluster_options.get('maintenance-mode') == "true":
+        result = CheckResult('maintenance')
+        result.log(logging.WARNING, "Cluster in maintenance mode!")
+        return [result]
+
+    checks = [CheckResult('nodes')]
+    resource_ids = selected_resources(model, args)
+
+    if resource_ids is None:
+        check_nodes(model, checks[-1])
+
+        if args.history:
+            checks.append(CheckResult('history'))
+            if getattr(args, 'history_state', None):
+                with HistoryState(args.history_state,
+                                  args.history_window) as state:
+                    check_history(model, checks[-1], state)
             else:
-                LOG.warning("%s stonith nodes configured out of %s nodes" %
-                      (stonith_nodes, Nodes.count()))
-            if rc == 0:
-                rc = 1
+                check_history(model, checks[-1])
+    else:
+        check_node_count(model, checks[-1])
+
+    if resource_ids is None:
+        checks.append(CheckResult('resources'))
+        check_resources(model, checks[-1])
+    elif not resource_ids:
+        checks.append(CheckResult('resource:%s' % args.resource_regex))
+        checks[-1].log(logging.ERROR, "No resources match %s" %
+                       args.resource_regex)
+    else:
+        for resource_id in resource_ids:
+            checks.append(CheckResult('resource:%s' % resource_id))
+            check_resource(model, checks[-1], resource_id)
 
-    def percentage(part, whole):
-        return 100 * float(part)/float(whole)
+    if args.stonith:
+        checks.append(CheckResult('stonith'))
+        check_stonith(model, checks[-1], args.stonith_agent)
 
-    perc_maint = percentage(maintenance_nodes, Nodes.count())
-    perc_standby = percentage(standby_nodes, Nodes.count())
-    if perc_maint > 50:
-        LOG.warning("More than half of the cluster nodes"
-              " are in maintenance (%.1f)" % perc_maint)
-        if rc == 0:
-            rc = 1
+    return checks
 
-    if perc_standby > 50:
-        LOG.warning("More than half of the cluster nodes"
-              " are in standby mode (%.1f)" % perc_standby)
-        if rc == 0:
-            rc = 1
 
-    if args.resource and resource_found is False:
-        LOG.error("Did not find resource %s" % args.resource)
-        rc = 2
+def merge_checks(checks):
+    """ Combined (rc, messages) of several checks """
+    rc = max([c.rc for c in checks] or [0])
+    messages = [m for c in checks for m in c.messages]
+    if rc == 0:
+        messages.append((logging.INFO, "Cluster health OK"))
+    return rc, messages
+
 
+def summary_line(rc, messages):
+    """ One line for a merge_checks() result: the health OK line
+        of a healthy cluster, else the first of the most severe
+        messages
+    """
     if rc == 0:
-        LOG.info("Cluster health OK")
+        return messages[-1][1]
+    return max(messages, key=lambda m: m[0])[1]
+
+
+def evaluate(model, args):
+    """ Run the checks selected in args against a ClusterModel.
+        Returns (rc, messages) where messages is a list of
+        (logging level, text) in the order they were found.
+    """
+    return merge_checks(run_checks(model, args))
+
+
+def load_model(args, stats=None):
+    """ Returns (model, age), age being how old the cached
+        crm_mon output is, or None when crm_mon just ran.
+    """
+    stats = {} if stats is None else stats
+    xml, age = None, None
+    if args.cache:
+        start = time.time()
+        try:
+            xml, age = get_cached_crm_xml(args.crm_mon, args.cache,
+                                          args.cache_ttl)
+        except (IOError, OSError) as e:
+            LOG.debug("Cache %s not usable: %s" % (args.cache, e))
+        stats['fetch_time'] = time.time() - start
+
+    model = get_crm_output(args.crm_mon, xml, stats)
+
+    # cibadmin is only run for old crm_mon versions
+    start = time.time()
+    model = with_cluster_properties(model, args.cibadmin)
+    stats['fetch_time'] = stats.get('fetch_time', 0) + time.time() - start
+    return model, age
+
+
+def cluster_perfdata(model, agent):
+    """ Nagios performance data of a ClusterModel, a list of
+        (label, value, unit, min, max). Stonith coverage is the
+        percentage of nodes with an active `agent` device.
+    """
+    nodes = dict.fromkeys(('online', 'offline', 'standby', 'maintenance',
+                           'unclean'), 0)
+    for node in model.nodes:
+        if node.maintenance:
+            nodes['maintenance'] += 1
+        elif node.standby:
+            nodes['standby'] += 1
+        elif not node.online:
+            nodes['offline'] += 1
+        else:
+            nodes['online'] += 1
+        if node.unclean:
+            nodes['unclean'] += 1
+
+    primitives = list(model.resources) + \
+        [r for c in model.clones for r in c.resources]
+    started = len([r for r in primitives
+                   if r.active and r.role in ('Started', 'Master', 'Slave')])
+    failed = len([r for r in primitives if r.failed]) + \
+        len([c for c in model.clones if c.failed])
+    devices = len([r for r in model.resources
+                   if r.active and not r.failure_ignored and
+                   r.resource_agent == agent])
+    coverage = 100.0 * min(devices, len(model.nodes)) / len(model.nodes) \
+        if model.nodes else 0.0
+    history_failures = len([op for node in active_nodes(model)
+                            for rh in node.history for op in rh.operations
+                            if op.rc != 0 and op.rc != 8])
+
+    perfdata = [('nodes_configured', model.nodes_configured or 0, '', 0, None)]
+    perfdata.extend(('nodes_%s' % state, nodes[state], '', 0, None)
+                    for state in ('online', 'offline', 'standby',
+                                  'maintenance', 'unclean'))
+    perfdata.extend([
+        ('resources', len(primitives), '', 0, None),
+        ('resources_started', started, '', 0, None),
+        ('resources_failed', failed, '', 0, None),
+        ('stonith_devices', devices, '', 0, None),
+        ('stonith_coverage', coverage, '%', 0, 100),
+        ('history_failures', history_failures, '', 0, None),
+    ])
+    return perfdata
+
+
+def timing_perfdata(stats):
+    """ Performance data of the checker itself from the stats
+        recorded by load_model() and the check run.
+    """
+    perfdata = []
+    for label, unit in (('fetch_time', 's'), ('xml_size', 'B'),
+                        ('parse_time', 's'), ('evaluate_time', 's')):
+        if label in stats:
+            perfdata.append((label, stats[label], unit, 0, None))
+    return perfdata
+
+
+def format_perfdata(perfdata):
+    """ Nagios plugin performance data string """
+    items = []
+    for label, value, unit, low, high in perfdata:
+        if isinstance(value, float):
+            value = '%.6f' % value if unit == 's' else '%.1f' % value
+        items.append(("%s=%s%s;;;%s;%s" % (
+            label, value, unit, '' if low is None else low,
+            '' if high is None else high)).rstrip(';'))
+    return ' '.join(items)
+
+
+class StatusDaemon(object):
+    """ Keeps the parsed cluster model of the last crm_mon run
+        and answers check queries from it. Results are cached
+        per query until the next refresh.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.model = None
+        self.stats = {}
+        self.updated = None
+        self.error = None
+        self.results = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def refresh(self):
+        start = time.time()
+        stats = {}
+        try:
+            model, __ = load_model(self.args, stats)
+        except Exception as e:
+            LOG.error("Status refresh failed: %s" % e)
+            with self.lock:
+                self.error = str(e)
+            return
+
+        with self.lock:
+            self.model = model
+            self.stats = stats
+            self.updated = time.time()
+            self.error = None
+            self.results = {}
+        LOG.debug('Status refreshed in %.3fs' % (time.time() - start))
+
+    def run_refresh(self):
+        while True:
+            self.refresh()
+            self.wakeup.wait(self.args.refresh)
+            self.wakeup.clear()
+
+    def query(self, request):
+        if request.get('refresh'):
+            self.wakeup.set()
+            return {'rc': 0, 'messages': []}
+
+        options = tuple(tuple(v) if isinstance(v, list) else v
+                        for v in (request.get(k) for k in QUERY_OPTIONS))
+        with self.lock:
+            model, updated, error = self.model, self.updated, self.error
+            stats = self.stats
+            cached = self.results.get(options)
+        if model is None:
+            return {'error': error or 'No status yet'}
+
+        if cached is None:
+            query = argparse.Namespace(**dict(zip(QUERY_OPTIONS, options)))
+            start = time.time()
+            checks = run_checks(model, query)
+            cached = {'checks': [c.as_dict() for c in checks],
+                      'updated': updated}
+            if query.perfdata:
+                stats = dict(stats, evaluate_time=time.time() - start)
+                cached['perfdata'] = cluster_perfdata(
+                    model, query.stonith_agent) + timing_perfdata(stats)
+            # Incremental history results depend on the state
+            # file, not only on the cluster status
+            with self.lock:
+                if self.updated == updated and \
+                        not request.get('history_state'):
+                    self.results[options] = cached
+
+        response = dict(cached, age=time.time() - updated)
+        if error:
+            response['refresh_error'] = error
+        return response
+
+
+class QueryHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            response = self.server.status.query(request)
+        except Exception as e:
+            response = {'error': str(e)}
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+class QueryServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def run_daemon(args):
+    status = StatusDaemon(args)
+    signal.signal(signal.SIGHUP, lambda signum, frame: status.wakeup.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    server = QueryServer(args.socket, QueryHandler)
+    server.status = status
+
+    if args.pidfile:
+        with open(args.pidfile, 'w') as f:
+            f.write('%d\n' % os.getpid())
+
+    refresher = threading.Thread(target=status.run_refresh)
+    refresher.daemon = True
+    refresher.start()
+
+    LOG.info("Serving check queries on %s" % args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+    return 0
+
+
+def query_daemon(args, timeout=2.0):
+    """ Ask a running daemon to evaluate the checks in args.
+        Returns (checks, age, perfdata) or None if the daemon could
+        not answer, in which case the caller runs the check itself.
+    """
+    if not os.path.exists(args.socket):
+        return None
+
+    request = dict((k, getattr(args, k)) for k in QUERY_OPTIONS)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(args.socket)
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        response = json.loads(sock.makefile('rb').readline().decode('utf-8'))
+    except (socket.error, ValueError) as e:
+        LOG.debug("Daemon query failed: %s" % e)
+        return None
+    finally:
+        sock.close()
+
+    if 'error' in response:
+        LOG.debug("Daemon error: %s" % response['error'])
+        return None
+    if response['age'] > args.max_age:
+        LOG.debug("Daemon status is %.1fs old, not using it" %
+                  response['age'])
+        return None
+
+    return ([CheckResult.from_dict(c) for c in response['checks']],
+            response['age'], [tuple(p) for p in response.get('perfdata', [])])
+
+
+def evaluate_snapshot(xml, args):
+    """ Parse and evaluate one crm_mon XML document. Runs in a
+        worker process, returns a JSON serialisable dict.
+    """
+    start = time.time()
+    try:
+        model = parse_crm_xml(xml)
+    except Exception as e:
+        return {'rc': 3, 'status': NAGIOS_STATUS[3], 'last_update': None,
+                'error': "Error parsing XML output: %s" % e}
+
+    parse_time = time.time() - start
+    checks = run_checks(model, args)
+    rc, messages = merge_checks(checks)
+    entry = {'rc': rc, 'status': NAGIOS_STATUS[rc],
+             'last_update': parse_rc_change(model.last_update),
+             'summary': summary_line(rc, messages),
+             'checks': [c.as_dict() for c in checks],
+             'parse_time': parse_time,
+             'evaluate_time': time.time() - start - parse_time}
+    if args.perfdata:
+        entry['perfdata'] = dict(
+            (p[0], p[1]) for p in cluster_perfdata(model, args.stonith_agent))
+    return entry
+
+
+def replay_snapshot(path, args):
+    with open(path, 'rb') as f:
+        entry = evaluate_snapshot(f, args)
+    entry.update(file=path,
+                 time=entry['last_update'] or os.path.getmtime(path))
+    return entry
+
+
+def _replay_worker(job):
+    return replay_snapshot(*job)
+
+
+def replay_corpus(args):
+    """ Evaluate all *.xml snapshots in a directory in a process
+        pool and print them as a timeline ordered by the time
+        crm_mon recorded. Returns the worst return code.
+    """
+    paths = sorted(os.path.join(args.xml, name)
+                   for name in os.listdir(args.xml) if name.endswith('.xml'))
+    if not paths:
+        sys.stderr.write("Error: no *.xml files in %s\n" % args.xml)
+        return 3
+
+    # The state file would be updated out of order
+    args.history_state = None
+    pool = Pool(args.workers)
+    try:
+        timeline = pool.map(_replay_worker, [(p, args) for p in paths],
+                            chunksize=max(1, len(paths) // 64))
+    finally:
+        pool.close()
+        pool.join()
+
+    timeline.sort(key=lambda e: (e['time'], e['file']))
+    rc = max(e['rc'] for e in timeline)
+    if args.output == 'json':
+        print(json.dumps({'rc': rc, 'status': NAGIOS_STATUS[rc],
+                          'timeline': timeline}, sort_keys=True))
+        return rc
+
+    for e in timeline:
+        print("%s %-8s %s: %s" % (
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(e['time'])),
+            e['status'], os.path.basename(e['file']),
+            e.get('error') or e['summary']))
+    return rc
+
+
+def run_command(command, timeout):
+    """ stdout of a command, killed after timeout seconds """
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        proc.kill()
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        stdout, stderr = proc.communicate()
+    finally:
+        timer.cancel()
+    if proc.returncode != 0:
+        if timed_out.is_set():
+            raise CRMError("%s timed out after %ss" % (command[0], timeout))
+        raise CRMError("%s exited with %d %s" %
+                       (command[0], proc.returncode,
+                        stderr.decode('utf-8', 'replace').strip()))
+    return stdout
+
+
+def fetch_local(spec, args):
+    return run_command([args.crm_mon, '-r', '-1', '-X'], args.fetch_timeout)
+
+
+def fetch_ssh(spec, args):
+    return run_command(shlex.split(args.ssh_command.format(host=spec)),
+                       args.fetch_timeout)
+
+
+def fetch_cmd(spec, args):
+    return run_command(shlex.split(spec), args.fetch_timeout)
+
+
+def fetch_file(spec, args):
+    with open(spec, 'rb') as f:
+        return f.read()
+
+
+# Ways to get the crm_mon XML of a cluster, by spec prefix
+TRANSPORTS = {
+    'local': fetch_local,
+    'ssh': fetch_ssh,
+    'cmd': fetch_cmd,
+    'file': fetch_file,
+}
+
+
+def fetch_cluster(cluster, args):
+    name, __, spec = cluster.partition('=')
+    transport, __, spec = spec.partition(':')
+    start = time.time()
+    try:
+        xml = TRANSPORTS[transport](spec, args)
+        error = None
+    except Exception as e:
+        xml, error = None, str(e)
+    return name, xml, error, time.time() - start
+
+
+def _cluster_worker(job):
+    return evaluate_snapshot(*job)
+
+
+def check_clusters(args):
+    """ Fetch the status of all --cluster entries concurrently,
+        evaluate them in a process pool and print one aggregated
+        report. Returns the worst return code.
+    """
+    threads = ThreadPool(max(1, min(args.parallel, len(args.clusters))))
+    try:
+        fetched = threads.map(lambda c: fetch_cluster(c, args),
+                              args.clusters)
+    finally:
+        threads.close()
+        threads.join()
+
+    args.history_state = None
+    ok = [f for f in fetched if f[1] is not None]
+    pool = Pool(min(args.workers or cpu_count(), len(ok))) if ok else None
+    try:
+        evaluated = pool.map(_cluster_worker,
+                             [(f[1], args) for f in ok]) if ok else []
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # In the order of the fetched clusters without errors
+    evaluated = iter(evaluated)
+    report = []
+    for name, xml, error, fetch_time in fetched:
+        if error is not None:
+            entry = {'rc': 3, 'status': NAGIOS_STATUS[3],
+                     'error': "Fetch failed: %s" % error}
+        else:
+            entry = next(evaluated)
+            entry['xml_size'] = len(xml)
+        entry.update(cluster=name, fetch_time=fetch_time)
+        report.append(entry)
+
+    rc = max(e['rc'] for e in report)
+    if args.output == 'json':
+        print(json.dumps({'rc': rc, 'status': NAGIOS_STATUS[rc],
+                          'clusters': report}, sort_keys=True))
+        return rc
+
+    for e in report:
+        print("%-20s %-8s fetch %.3fs parse %.3fs: %s" % (
+            e['cluster'], e['status'], e['fetch_time'],
+            e.get('parse_time', 0), e.get('error') or e['summary']))
+    return rc
+
+
+def read_snapshot(source):
+    if source == '-':
+        return getattr(sys.stdin, 'buffer', sys.stdin).read()
+    with open(source, 'rb') as f:
+        return f.read()
+
+
+def check_cluster():
+    try:
+        args = parse_args()
+    except Exception as e:
+        sys.stderr.write("Error parsing arguments: %s\n" % e)
+        sys.exit(1)
+
+    set_logger(debug=args.debug)
+
+    if args.xml and os.path.isdir(args.xml):
+        return replay_corpus(args)
+
+    if args.clusters:
+        return check_clusters(args)
+
+    result = None
+    model = None
+    stats = {}
+    if args.xml:
+        try:
+            start = time.time()
+            xml = read_snapshot(args.xml)
+            stats['fetch_time'] = time.time() - start
+            model = get_crm_output(None, xml, stats)
+        except (CRMError, IOError) as e:
+            sys.stderr.write("Error: %s\n" % e)
+            sys.exit(2)
+        age = None
+    elif args.socket and not args.daemon:
+        result = query_daemon(args)
+
+    if result is None and model is None:
+        if not os.path.exists(args.crm_mon):
+            sys.stderr.write("Error: %s not found\n" % args.crm_mon)
+            sys.exit(3)
+
+        if args.daemon:
+            return run_daemon(args)
+
+        # Get XML output
+        try:
+            model, age = load_model(args, stats)
+        except CRMError as e:
+            sys.stderr.write("Error: %s\n" % e)
+            sys.exit(2)
+        except:
+            sys.stderr.write(traceback.format_exc())
+            sys.exit(2)
+
+    if model is not None:
+        start = time.time()
+        checks = run_checks(model, args)
+        stats['evaluate_time'] = time.time() - start
+        perfdata = []
+        if args.perfdata:
+            perfdata = cluster_perfdata(model, args.stonith_agent) + \
+                timing_perfdata(stats)
+    else:
+        checks, age, perfdata = result
+
+    rc, messages = merge_checks(checks)
+    if args.output == 'json':
+        output = {'rc': rc, 'status': NAGIOS_STATUS[rc],
+                  'checks': [c.as_dict() for c in checks]}
+        if age is not None:
+            output['age'] = age
+        if perfdata:
+            output['perfdata'] = dict((p[0], p[1]) for p in perfdata)
+        print(json.dumps(output, sort_keys=True))
+        return rc
+
+    for level, msg in messages:
+        LOG.log(level, msg)
+
+    if age is not None:
+        LOG.info("Cluster status is %.1fs old" % age)
+
+    # Performance data after the long output, see the
+    # Nagios plugin API
+    if perfdata:
+        print("| %s" % format_perfdata(perfdata))
 
     return rc
 
@@ -1,7 +1,4 @@
 #!/usr/bin/env python
-from keystoneauth1 import identity
-from keystoneauth1 import session
-from neutronclient.v2_0 import client
 from subprocess import call
 from os import environ
 import sys
@@ -165,6 +162,12 @@ def main():
     project_name = environ['OS_TENANT_NAME']
     auth_url = environ['OS_AUTH_URL']
 
+    # Client libraries are slow to import, load them
+    # once the environment is known to be usable
+    from keystoneauth1 import identity
+    from keystoneauth1 import session
+    from neutronclient.v2_0 import client
+
     auth = identity.Password(auth_url=auth_url,
                              username=username,
                              password=password,
@@ -0,0 +1,91 @@
+""" Stand-in for the Ansible ssh connection, used by
+    bench-api-ansible.py --simulate. Runs everything locally
+    but sleeps for what ssh would cost: a handshake for every
+    ssh, sftp or scp call unless a ControlPersist master to the
+    host is still up, and a round trip per file transferred.
+    Pipelined modules skip the transfer as they would over ssh.
+    Costs in milliseconds come from SIMULATED_SSH_HANDSHAKE and
+    SIMULATED_SSH_TRANSFER, masters are files in
+    SIMULATED_SSH_CONTROL_DIR.
+"""
+import os
+import re
+import shlex
+import time
+
+from ansible.plugins.connection.local import Connection as LocalConnection
+
+
+def ssh_option(args, name):
+    """ Value of the first -o name=value in args, as ssh uses it """
+    words = shlex.split(args or '')
+    for i, word in enumerate(words):
+        if word == '-o' and i + 1 < len(words):
+            word = words[i + 1]
+        elif word.startswith('-o'):
+            word = word[2:]
+        else:
+            continue
+        key, __, value = word.replace(' ', '=', 1).partition('=')
+        if key.lower() == name.lower():
+            return value
+    return None
+
+
+def seconds(value):
+    """ ControlPersist value in seconds, None for forever """
+    if value in (None, 'no'):
+        return 0
+    if value == 'yes':
+        return None
+    units = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    match = re.match(r'^(\d+)([smhdw]?)$', value.lower())
+    return int(match.group(1)) * units[match.group(2)] if match else 0
+
+
+class Connection(LocalConnection):
+    """ Local connection with the latency of ssh """
+
+    transport = 'simulated_ssh'
+
+    def persist(self):
+        """ Seconds an idle master stays up, 0 without one """
+        args = ' '.join(a for a in (self._play_context.ssh_args,
+                                    self._play_context.ssh_common_args) if a)
+        if ssh_option(args, 'ControlMaster') in (None, 'no'):
+            return 0
+        return seconds(ssh_option(args, 'ControlPersist'))
+
+    def ssh(self):
+        """ Pay for one ssh call """
+        persist = self.persist()
+        master = os.path.join(os.environ['SIMULATED_SSH_CONTROL_DIR'],
+                              self._play_context.remote_addr or 'localhost')
+        try:
+            idle = time.time() - os.stat(master).st_mtime
+            alive = persist is None or idle < persist
+        except OSError:
+            alive = False
+        if not alive:
+            time.sleep(float(os.environ.get('SIMULATED_SSH_HANDSHAKE',
+                                            150)) / 1000)
+        if persist != 0:
+            with open(master, 'a'):
+                os.utime(master, None)
+
+    def transfer(self):
+        self.ssh()
+        time.sleep(float(os.environ.get('SIMULATED_SSH_TRANSFER', 30)) / 1000)
+
+    def exec_command(self, cmd, in_data=None, sudoable=True):
+        self.ssh()
+        return super(Connection, self).exec_command(cmd, in_data=in_data,
+                                                    sudoable=sudoable)
+
+    def put_file(self, in_path, out_path):
+        self.transfer()
+        return super(Connection, self).put_file(in_path, out_path)
+
+    def fetch_file(self, in_path, out_path):
+        self.transfer()
+        return super(Connection, self).fetch_file(in_path, out_path)
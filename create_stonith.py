@@ -1,12 +1,14 @@
 #!/usr/bin/env python
+import argparse
 import os
 import json
+import shlex
+import signal
+import subprocess
 import sys
+import threading
+import time
 from pprint import pprint
-from keystoneauth1 import identity
-from keystoneauth1 import session
-from ironicclient import client as ironic_client
-from novaclient import client as nova_client
 
 """
 Credit to: https://github.com/rscarazz/tripleo-director-instance-ha/blob/master/create-stonith-from-instackenv.py
@@ -41,8 +43,156 @@ Based on the IPMI addresses (or SSH address) of the controllers
 #},
 #...
 
+# Fence agent exit codes of the status action
+POWER_ON = 0
+POWER_OFF = 2
+
+# Run fence agents in their own session so a timeout can kill
+# their children too. preexec_fn can deadlock in threads on
+# Python 3, which has start_new_session instead.
+if sys.version_info[0] >= 3:
+    NEW_SESSION = {'start_new_session': True}
+else:
+    NEW_SESSION = {'preexec_fn': os.setsid}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Output pcs commands to enable stonith on the'
+                    ' overcloud controllers')
+
+    parser.add_argument('instackenv', metavar='instackenv.json', nargs='?',
+                        help='Node definitions with the BMC credentials')
+
+    parser.add_argument('--validate', action='store_true',
+                        help='Query the power status of every IPMI node'
+                             ' first and stop before any pcs command is'
+                             ' output if one fails')
+
+    parser.add_argument('--validate-only', action='store_true',
+                        help='Only validate the BMCs, needs no OpenStack'
+                             ' credentials')
+
+    parser.add_argument('--fence-agent', metavar='cmd', type=str,
+                        default='fence_ipmilan',
+                        help='Fence agent used for validation. Gets the'
+                             ' options on stdin, the way pacemaker passes'
+                             ' them. Default: %(default)s')
+
+    parser.add_argument('--probe-workers', metavar='int', type=int,
+                        default=32,
+                        help='BMCs to query in parallel.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--probe-timeout', metavar='sec', type=int,
+                        default=20,
+                        help='Kill a fence agent running longer than this.'
+                             ' Default: %(default)s')
+
+    return parser.parse_args(argv)
+
+
+def node_label(node):
+    return node.get('_comment') or node.get('name') or node.get('pm_addr')
+
+
+def find_command(name):
+    if os.path.dirname(name):
+        return name if os.access(name, os.X_OK) else None
+    for path in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        if os.access(os.path.join(path, name), os.X_OK):
+            return os.path.join(path, name)
+    return None
+
+
+def probe_bmc(node, agent, timeout):
+    """ Run the status action of the fence agent against the
+        BMC of a node. Returns an error message, None when the
+        BMC reported a power state.
+    """
+    missing = [k for k in ('pm_addr', 'pm_user', 'pm_password')
+               if not node.get(k)]
+    if missing:
+        return 'missing %s' % ', '.join(missing)
+
+    # Same options as the stonith resource, on stdin so the
+    # password does not show up in ps
+    options = ['action=status',
+               'ipaddr=%s' % node['pm_addr'],
+               'login=%s' % node['pm_user'],
+               'passwd=%s' % node['pm_password'],
+               'lanplus=1']
+    if node.get('pm_port'):
+        options.append('ipport=%s' % node['pm_port'])
+
+    try:
+        proc = subprocess.Popen(agent, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                close_fds=True, **NEW_SESSION)
+    except OSError as e:
+        return 'cannot run %s: %s' % (agent[0], e)
+
+    # Kill the whole process group, ipmitool would otherwise
+    # keep the pipe open
+    killed = []
+
+    def kill():
+        killed.append(True)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        output = proc.communicate(('\n'.join(options) + '\n').encode())[0]
+    finally:
+        timer.cancel()
+
+    if killed:
+        return 'timed out after %ds' % timeout
+    if proc.returncode in (POWER_ON, POWER_OFF):
+        return None
+    lines = output.decode('utf-8', 'replace').strip().splitlines()
+    return lines[-1] if lines else 'exit code %d' % proc.returncode
+
+
+def validate_bmcs(nodes, agent, workers=32, timeout=20):
+    """ Probe the BMCs of all IPMI nodes concurrently and write
+        a report to stderr. Returns the failed (node, error).
+    """
+    from multiprocessing.pool import ThreadPool
+
+    nodes = [n for n in nodes if 'ipmi' in n.get('pm_type', 'ipmi')]
+    if not nodes:
+        return []
+    agent = shlex.split(agent)
+    if not find_command(agent[0]):
+        sys.stderr.write("Fence agent %s not found\n" % agent[0])
+        return [(n, 'no fence agent') for n in nodes]
+    start = time.time()
+    pool = ThreadPool(max(1, min(workers, len(nodes))))
+    try:
+        errors = pool.map(lambda n: probe_bmc(n, agent, timeout), nodes)
+    finally:
+        pool.close()
+        pool.join()
+
+    failed = [(n, e) for n, e in zip(nodes, errors) if e]
+    for node, error in failed:
+        sys.stderr.write("BMC %s of %s: %s\n" % (node.get('pm_addr'),
+                                                 node_label(node), error))
+    sys.stderr.write("Validated %d BMCs in %.1fs: %d ok, %d failed\n" %
+                     (len(nodes), time.time() - start,
+                      len(nodes) - len(failed), len(failed)))
+    return failed
+
 
 def run():
+    args = parse_args()
+
     # Verify we've loaded overcloud environment
     try:
         os.environ['OS_CLOUDNAME']
@@ -55,16 +205,25 @@ def run():
             sys.exit(1)
 
     # Get location of instackenv.json
-    try:
-        jdata = open(sys.argv[1])
-    except IndexError as e:
+    if args.instackenv is None:
         sys.stderr.write("Missing the instackenv.json file location as"
                          " first argument\n")
         sys.exit(1)
 
     # Load instackenv.json data
-    data = json.load(jdata)
-    jdata.close()
+    with open(args.instackenv) as jdata:
+        data = json.load(jdata)
+
+    # Find bad BMCs now rather than on the first monitor
+    # or fence
+    if args.validate or args.validate_only:
+        failed = validate_bmcs(data["nodes"], args.fence_agent,
+                               workers=args.probe_workers,
+                               timeout=args.probe_timeout)
+        if failed:
+            sys.exit(1)
+        if args.validate_only:
+            sys.exit(0)
 
     # Load openstack auth details
     os_username = os.environ['OS_USERNAME']
@@ -78,6 +237,13 @@ def run():
     # Create the create-virt-key.sh script
     create_key_script()
 
+    # Client libraries are slow to import, load them
+    # once the arguments and environment are checked
+    from keystoneauth1 import identity
+    from keystoneauth1 import session
+    from ironicclient import client as ironic_client
+    from novaclient import client as nova_client
+
     # Auth to nova
     auth = identity.Password(auth_url=os_auth_url,
                              username=os_username,
@@ -112,7 +278,7 @@ def run():
         print('pcs stonith delete stonith-{} || /bin/true'.format(instance.name))
         ironic_node = ironic.node.get_by_instance_uuid(instance.id)
         # With IPMI address
-        if not ironic_node.driver_info.has_key("ipmi_address"):
+        if "ipmi_address" not in ironic_node.driver_info:
             if instance.name.find("control") > 0:
                 print('cat %s | ssh %s -- "cat > fence_prep.sh; sudo bash fence_prep.sh"' %
                       ("create-virt-key.sh", instance.addresses["ctlplane"][0]["addr"]))
@@ -133,7 +299,7 @@ def run():
                                                             node["pm_password"]))
     # Only when no IPMI address
     for host in hosts:
-        print "INSIDE"
+        print("INSIDE")
         virt_file = "fence-{}-prep.sh".format(hosts[host])
         fence_virt_prep="""
 wget http://download.eng.bos.redhat.com/brewroot/work/tasks/2585/10972585/fence-virt-{,debuginfo-}0.3.2-3.el7_2.x86_64.rpm
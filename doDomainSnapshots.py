@@ -1,12 +1,14 @@
 #!/usr/bin/env python
 import argparse
-import libvirt
+import contextlib
+import json
 import logging
+import threading
 import time
 import sys
 import os
+from multiprocessing.pool import ThreadPool
 from pprint import pformat
-from heapq import nlargest
 
 try:
     import xml.etree.ElementTree as ET
@@ -16,6 +18,35 @@ except ImportError:
 
 LOG = logging.getLogger(__name__)
 
+# Imported by load_libvirt() on first use, so that --help and
+# argument errors do not pay for loading the bindings
+libvirt = None
+
+DEFAULT_URI = 'qemu:///system'
+
+PRUNE_MODES = ('before', 'after', 'background', 'none')
+
+SNAPSHOT_MODES = ('internal', 'external')
+
+# VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY + VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC,
+# always set for external snapshots
+EXTERNAL_FLAGS = 16 + 128
+
+# VIR_DOMAIN_SNAPSHOT_DELETE_METADATA_ONLY, libvirt cannot delete
+# external snapshots itself
+METADATA_ONLY = 2
+
+# Seconds between block job polls and progress log lines
+BLOCK_JOB_POLL = 0.5
+PROGRESS_INTERVAL = 10
+
+# libvirt error codes worth retrying a snapshot delete for
+TRANSIENT_ERRORS = ('VIR_ERR_OPERATION_TIMEOUT',
+                    'VIR_ERR_AGENT_UNRESPONSIVE',
+                    'VIR_ERR_RPC',
+                    'VIR_ERR_SYSTEM_ERROR',
+                    'VIR_ERR_OPERATION_FAILED')
+
 
 """ C style enumeration flags for create snapshot.
     Source: https://libvirt.org/html/libvirt-libvirt-domain-snapshot.html#virDomainSnapshotCreateFlags
@@ -43,7 +74,7 @@ virDomainSnapshotDeleteFlags = {
     }
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawTextHelpFormatter,
         description='Create a snapshot for a domain.',
@@ -62,6 +93,21 @@ In addition use snapshot creation flags
 Snapshot 'snap_test' and keep 3 most-recent snapshots.
 In addition use snapshot creation and deletion flags
 {0} --domain snap_test --keep 3 --flags 152 --del-flags 4
+
+Snapshot 'web1' and 'web2' on two hypervisors, at most 2 domains
+at a time per hypervisor
+{0} --domain web1 --domain web2 --host-workers 2 \\
+    --qemu-uri qemu+ssh://hv1/system --qemu-uri qemu+ssh://hv2/system
+
+Snapshot 'web1' on every hypervisor listed in hosts.txt
+(one URI per line, '#' comments allowed)
+{0} --domain web1 --hosts-file hosts.txt
+
+External disk-only snapshots of 'web1', overlays in /var/lib/snap.
+Expired snapshots are committed out of the backing chains at
+most 50 MiB/s per disk, 2 disks at a time
+{0} --domain web1 --mode external --snapshot-dir /var/lib/snap \\
+    --keep 3 --bandwidth 50 --block-jobs 2
 """.format(sys.argv[0]))
 
     parser.add_argument('--snapshot-xml', metavar='xml',
@@ -72,18 +118,97 @@ File or XML tree. Example:
 https://libvirt.org/formatsnapshot.html#example""")
 
     parser.add_argument('--qemu-uri', metavar='uri', type=str,
-                        default='qemu:///system',
-                        help='Libvirt/Qemu connection URI. Default: %(default)s')
+                        action='append', dest='qemu_uris', default=[],
+                        help='Libvirt/Qemu connection URI. Can be repeated'
+                             ' to snapshot on several hypervisors.'
+                             ' Default: %s' % DEFAULT_URI)
+
+    parser.add_argument('--hosts-file', metavar='file',
+                        type=hosts_file_type,
+                        help='File with one connection URI per line,'
+                             ' e.g. qemu+ssh://host/system')
 
     parser.add_argument('--domain', metavar='name', type=str,
-                        required=True,
-                        help='Domain name to snapshot.')
+                        action='append', dest='domains', required=True,
+                        help='Domain name to snapshot. Can be repeated.')
+
+    parser.add_argument('--parallel', metavar='int', type=int,
+                        default=4,
+                        help='Number of hypervisors to process in parallel.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--metrics-json', metavar='file', type=str,
+                        help='Write per-phase timing events as JSON lines'
+                             ' to file ("-" for stdout)')
+
+    parser.add_argument('--metrics-prom', metavar='file', type=str,
+                        help='Write metrics in Prometheus textfile collector'
+                             ' format, e.g. /var/lib/node_exporter/'
+                             'domsnapshot.prom')
+
+    parser.add_argument('--host-workers', metavar='int', type=int,
+                        default=1,
+                        help='Number of domains to process in parallel on'
+                             ' each hypervisor. Default: %(default)s')
 
     parser.add_argument('--keep', metavar='int', type=int,
                         default=2,
                         help='Number of snapshots to keep, excluding the new one.'
                              ' Will delete older ones. Default: %(default)s')
 
+    parser.add_argument('--prune', choices=PRUNE_MODES, default='before',
+                        help='When to delete expired snapshots: before or'
+                             ' after creating the new ones, in a detached'
+                             ' background process after creation, or never.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--prune-workers', metavar='int', type=int,
+                        default=4,
+                        help='Maximum concurrent snapshot deletions across'
+                             ' all domains and hypervisors in the after and'
+                             ' background prune modes. Default: %(default)s')
+
+    parser.add_argument('--delete-retries', metavar='int', type=int,
+                        default=3,
+                        help='Retries for transient libvirt errors while'
+                             ' deleting a snapshot. Default: %(default)s')
+
+    parser.add_argument('--mode', choices=SNAPSHOT_MODES, default='internal',
+                        help='Internal snapshots, or external disk-only'
+                             ' snapshots with one qcow2 overlay per disk.'
+                             ' Expired external snapshots are merged out of'
+                             ' the backing chains with block jobs, which'
+                             ' need a running domain: those of shut off'
+                             ' domains are kept until a run finds it'
+                             ' running. Default: %(default)s')
+
+    parser.add_argument('--snapshot-dir', metavar='dir', type=str,
+                        help='Directory on the hypervisor for external'
+                             ' snapshot overlays. Defaults to the directory'
+                             ' of each disk image. Merged overlays on remote'
+                             ' hypervisors can only be deleted if the'
+                             ' directory is a storage pool')
+
+    parser.add_argument('--max-chain', metavar='int', type=int, default=8,
+                        help='Maximum backing chain length (base image and'
+                             ' overlays) in external mode. Lowers --keep'
+                             ' when needed. Default: %(default)s')
+
+    parser.add_argument('--bandwidth', metavar='MiB/s', type=int, default=0,
+                        help='Bandwidth limit per block job when merging'
+                             ' external snapshots, 0 for unlimited.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--block-jobs', metavar='int', type=int, default=4,
+                        help='Maximum concurrent block jobs across all'
+                             ' disks, domains and hypervisors.'
+                             ' Default: %(default)s')
+
+    parser.add_argument('--block-job-timeout', metavar='sec', type=int,
+                        default=3600,
+                        help='Abort block jobs running longer than this.'
+                             ' Default: %(default)s')
+
     parser.add_argument('--debug', '-d', action='store_true',
                         help='Debug output')
 
@@ -106,7 +231,29 @@ Representing choices or the sum, e.g. syntax 1+8+16. Used for snapshot deletion.
 Representing choices or the sum, e.g. syntax 1+8+16. Used for snapshot creation. 
 %s''' % pformat(virDomainSnapshotCreateFlags, width=80,indent=2))
 
-    return parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.max_chain < 2:
+        parser.error('--max-chain must be at least 2')
+    if args.hosts_file:
+        args.qemu_uris.extend(args.hosts_file)
+    if not args.qemu_uris:
+        args.qemu_uris = [DEFAULT_URI]
+    seen = set()
+    args.qemu_uris = [u for u in args.qemu_uris
+                      if not (u in seen or seen.add(u))]
+    return args
+
+
+def hosts_file_type(path):
+    uris = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                uris.append(line)
+    if not uris:
+        raise argparse.ArgumentTypeError("No URIs found in %s" % path)
+    return uris
 
 
 def snapshot_flags_del_type(flags):
@@ -158,32 +305,117 @@ def snapshot_xml_type(xml):
     return root  
 
 
-def delete_older_snapshots(dom, keep, flags=0):
-    c_times = {}
-    snap_list = dom.snapshotListNames()
-    for name in snap_list:
-        try:
-            snapshot = dom.snapshotLookupByName(name)
-        except Exception as e:
-            LOG.warning("Skip item, not found? %s" % e)
-            continue
-        root = ET.fromstring(snapshot.getXMLDesc())
-        c_time = root.find('creationTime').text
-        c_times[c_time] = name
+def find_expired_snapshots(dom, keep, metrics=None, uri=None):
+    """ Return (creation time, name, overlays) of all but the
+        newest `keep` snapshots of a domain, oldest first.
+        overlays is empty for internal snapshots.
+    """
+    metrics = metrics or Metrics()
+    c_times = []
+    with metrics.timer('enumerate', uri=uri, domain=dom.name()):
+        snap_list = dom.snapshotListNames()
+        for name in snap_list:
+            try:
+                snapshot = dom.snapshotLookupByName(name)
+            except Exception as e:
+                LOG.warning("Skip item, not found? %s" % e)
+                continue
+            root = ET.fromstring(snapshot.getXMLDesc())
+            c_time = int(root.find('creationTime').text)
+            c_times.append((c_time, name, snapshot_overlays(root)))
 
-    # Keep the newest n number of snapshots 
-    to_keep = nlargest(keep, c_times)
-    for remove_newest in to_keep:
+    # Keep the newest n number of snapshots
+    c_times.sort()
+    expired = c_times[:max(0, len(c_times) - keep)]
+    for c_time, name, __ in c_times[len(expired):]:
         LOG.debug("Exclude newer snapshot '%s' time %s" %
-                  (c_times[remove_newest],
-                   time.strftime('%Y-%m-%d %H:%M:%S',
-                                 time.localtime(int(remove_newest))
-                                )
-                  ))
+                  (name, time.strftime('%Y-%m-%d %H:%M:%S',
+                                       time.localtime(c_time))))
+
+    return expired
+
+
+def disk_source(node):
+    source = node.find('source')
+    if source is None:
+        return None
+    return source.get('file') or source.get('dev') or source.get('name')
+
+
+def snapshot_overlays(root):
+    """ {disk: overlay image} of an external snapshot XML """
+    overlays = {}
+    for disk in root.findall('disks/disk'):
+        if disk.get('snapshot') == 'external' and disk_source(disk):
+            overlays[disk.get('name')] = disk_source(disk)
+    return overlays
+
+
+def disk_chains(dom):
+    """ Backing chain of every disk of a domain, active image
+        first, as {target dev: [image, ...]}. libvirt older than
+        1.2.4 only reports the active image.
+    """
+    root = ET.fromstring(dom.XMLDesc(0))
+    chains = {}
+    for disk in root.findall("devices/disk[@device='disk']"):
+        target = disk.find('target')
+        chain = []
+        node = disk
+        while node is not None and disk_source(node):
+            chain.append(disk_source(node))
+            node = node.find('backingStore')
+        if target is not None and chain:
+            chains[target.get('dev')] = chain
+    return chains
+
+
+def chain_depth(dom, max_chain=None):
+    """ Length of the longest backing chain of a domain """
+    try:
+        depth = max([len(c) for c in disk_chains(dom).values()] or [0])
+    except Exception as e:
+        LOG.debug("No backing chain info for %s: %s" % (dom.name(), e))
+        return None
+    if max_chain and depth > max_chain:
+        LOG.warning("Backing chain of %s is %d images long, more than"
+                    " --max-chain %d. Images without snapshot metadata"
+                    " are not merged automatically" %
+                    (dom.name(), depth, max_chain))
+    return depth
+
 
-        del c_times[remove_newest]
+def load_libvirt():
+    global libvirt
+    if libvirt is None:
+        import libvirt as module
+        libvirt = module
+    return libvirt
 
-    for c_time, name in c_times.items():
+
+def is_transient_error(e):
+    if libvirt is None or not isinstance(e, libvirt.libvirtError):
+        return False
+    codes = [getattr(libvirt, c, None) for c in TRANSIENT_ERRORS]
+    return e.get_error_code() in codes
+
+
+def delete_snapshots(dom, expired, flags=0, metrics=None, uri=None,
+                     retries=0, retry_delay=1.0, jobs=None, removed=None):
+    """ Delete the given (creation time, name, overlays) snapshots
+        of a domain, retrying transient libvirt errors. External
+        snapshots are merged out of the backing chains with
+        `jobs`, the allocation of each merged image deleted is
+        appended to `removed`. Returns deleted names.
+    """
+    metrics = metrics or Metrics()
+    labels = {'uri': uri, 'domain': dom.name()}
+    deleted = []
+    external = []
+    for c_time, name, overlays in expired:
+        if overlays:
+            external.append((name, overlays))
+            continue
         LOG.debug('Get snapshot %s object' % name)
         try:
             snapshot = dom.snapshotLookupByName(name)
@@ -192,26 +424,712 @@ def delete_older_snapshots(dom, keep, flags=0):
             continue
         LOG.info("Delete snapshot '%s' time %s" % (name,
                  time.strftime('%Y-%m-%d %H:%M:%S',
-                               time.localtime(int(c_time))
-                              )
+                               time.localtime(c_time))
                 ))
+        for attempt in range(retries + 1):
+            try:
+                with metrics.timer('delete', snapshot=name, **labels):
+                    snapshot.delete(flags=flags)
+            except Exception as e:
+                if attempt < retries and is_transient_error(e):
+                    LOG.warning("Transient error deleting snapshot %s,"
+                                " retrying: %s" % (name, e))
+                    time.sleep(retry_delay * 2 ** attempt)
+                    continue
+                LOG.error("Failed to delete snapshot %s: %s" %
+                          (name, e))
+            else:
+                deleted.append(name)
+            break
+
+    if external:
+        jobs = jobs or BlockJobs(metrics=metrics)
+        deleted.extend(consolidate_snapshots(dom, external, jobs, uri=uri,
+                                             removed=removed))
+    return deleted
+
+
+def delete_older_snapshots(dom, keep, flags=0, metrics=None, uri=None,
+                           retries=0, jobs=None):
+    """ Delete all but the newest `keep` snapshots of a domain.
+        Returns the list of deleted snapshot names.
+    """
+    expired = find_expired_snapshots(dom, keep, metrics=metrics, uri=uri)
+    return delete_snapshots(dom, expired, flags=flags, metrics=metrics,
+                            uri=uri, retries=retries, jobs=jobs)
+
+
+def plan_consolidation(chains, snapshots):
+    """ Block commits removing the overlays of the expired
+        external snapshots, given oldest first as (name, overlays),
+        from the backing chains. Returns (disk, base, top, merged
+        overlays) per disk; top is None when the range reaches
+        the active image.
+    """
+    plans = []
+    for disk in sorted(set(d for __, o in snapshots for d in o)):
+        chain = chains.get(disk, [])
+        overlays = [o[disk] for __, o in snapshots
+                    if disk in o and o[disk] in chain]
+        if not overlays:
+            LOG.debug("Overlays of %s already merged" % disk)
+            continue
+        # Everything from the newest expired overlay down to the
+        # image the oldest one was created on becomes one image
+        top = chain.index(overlays[-1])
+        base = chain.index(overlays[0]) + 1
+        if base >= len(chain):
+            LOG.warning("No backing image below %s, cannot merge" %
+                        overlays[0])
+            continue
+        merged = [i for i in chain[top:base] if i in overlays]
+        plans.append((disk, chain[base], chain[top] if top else None,
+                      merged))
+    return plans
+
+
+def is_local_uri(uri):
+    """ Whether a libvirt URI has no host part, so its images
+        are files on this host
+    """
+    return bool(uri) and not uri.partition('://')[2].split('/', 1)[0]
+
+
+def remove_image(conn, path, uri=None, metrics=None, **labels):
+    """ Delete a merged image through its storage pool, or as a
+        file when the hypervisor is this host. Images left behind
+        are recorded as leak events. Returns the allocated bytes
+        of the deleted image, None if it was not deleted.
+    """
+    try:
+        vol = conn.storageVolLookupByPath(path)
+        allocation = vol.info()[2]
+        vol.delete(0)
+        return allocation
+    except Exception as e:
+        error = e
+
+    if is_local_uri(uri):
+        try:
+            allocation = os.stat(path).st_blocks * 512
+            os.remove(path)
+            return allocation
+        except OSError as e:
+            error = e
+
+    LOG.warning("Merged image %s left behind, not in a storage pool? %s" %
+                (path, error))
+    if metrics is not None:
+        metrics.add('leak', 0.0, error=str(error), uri=uri, path=path,
+                    **labels)
+    return None
+
+
+def consolidate_snapshots(dom, snapshots, jobs, uri=None, removed=None):
+    """ Merge the overlays of expired external snapshots, given
+        oldest first as (name, overlays), out of the backing
+        chains, all disks in parallel, then delete the snapshot
+        metadata and the merged images, appending the allocation
+        of each deleted image to `removed`. When a disk fails the
+        metadata is kept so the next run retries. Block jobs need
+        a running domain, nothing is done for a shut off one.
+        Returns the deleted snapshot names.
+    """
+    names = [name for name, __ in snapshots]
+    if not dom.isActive():
+        LOG.warning("Cannot merge snapshots %s of %s, block jobs need a"
+                    " running domain. Kept until a run finds it running" %
+                    (', '.join(names), dom.name()))
+        return []
+    plans = plan_consolidation(disk_chains(dom), snapshots)
+    LOG.info("Merge snapshots %s of %s: %s" % (
+        ', '.join(names), dom.name(),
+        ', '.join('%s into %s' % (d, b) for d, b, t, m in plans) or
+        'nothing to do'))
+
+    def run(plan):
+        disk, base, top, merged = plan
+        try:
+            jobs.run(dom, disk, base, top, uri=uri)
+        except Exception as e:
+            LOG.error("Failed to merge %s of %s: %s" % (disk, dom.name(), e))
+            return False
+        # A job that fails on the hypervisor just disappears,
+        # so check the chain
+        chain = disk_chains(dom).get(disk, [])
+        if [i for i in merged if i in chain]:
+            LOG.error("Block job on %s of %s ended without merging %s" %
+                      (disk, dom.name(), ', '.join(merged)))
+            return False
+        for path in merged:
+            allocation = remove_image(dom.connect(), path, uri=uri,
+                                      metrics=jobs.metrics,
+                                      domain=dom.name())
+            if allocation is not None and removed is not None:
+                removed.append(allocation)
+        return True
+
+    if plans:
+        workers = ThreadPool(len(plans))
+        try:
+            if not all(workers.map(run, plans)):
+                return []
+        finally:
+            workers.close()
+            workers.join()
+
+    deleted = []
+    for name in names:
         try:
-            snapshot.delete(flags=flags) 
+            dom.snapshotLookupByName(name).delete(flags=METADATA_ONLY)
         except Exception as e:
-            LOG.error("Failed to delete snapshot %s: %s" %
-                      (name, e))
+            LOG.error("Failed to delete snapshot %s metadata: %s" % (name, e))
+            continue
+        deleted.append(name)
+    return deleted
+
+
+def disk_allocation(dom):
+    """ Sum of allocated bytes over the domain disks, or None
+        if the storage backend does not report it.
+    """
+    try:
+        root = ET.fromstring(dom.XMLDesc(0))
+        total = 0
+        for target in root.findall("devices/disk[@device='disk']/target"):
+            total += dom.blockInfo(target.attrib['dev'])[1]
+        return total
+    except Exception as e:
+        LOG.debug("No allocation info for %s: %s" % (dom.name(), e))
+        return None
 
 
 def connect_libvirt(qemu_uri):
     # Connect to libvirt
+    load_libvirt()
     conn = libvirt.open(qemu_uri)
     if conn is None:
-        LOG.error('Failed to open connection to the hypervisor\n')
-        sys.exit(1)
+        raise libvirt.libvirtError('Failed to open connection to %s' %
+                                   qemu_uri)
 
     return conn
 
 
+class ConnectionPool(object):
+    """ One shared libvirt connection per hypervisor URI.
+        libvirt connections are thread safe, so all workers
+        of a host reuse the same connection.
+    """
+
+    def __init__(self):
+        self._conns = {}
+        self._lock = threading.Lock()
+
+    def get(self, qemu_uri):
+        with self._lock:
+            conn = self._conns.get(qemu_uri)
+            if conn is None:
+                LOG.debug('Opening connection to %s' % qemu_uri)
+                conn = connect_libvirt(qemu_uri)
+                self._conns[qemu_uri] = conn
+            return conn
+
+    def close(self):
+        with self._lock:
+            for qemu_uri, conn in self._conns.items():
+                try:
+                    conn.close()
+                except Exception as e:
+                    LOG.warning("Error closing connection to %s: %s" %
+                                (qemu_uri, e))
+            self._conns.clear()
+
+
+class Metrics(object):
+    """ Thread safe collector of timing events.
+        Every event has a phase (connect, lookup, enumerate,
+        delete, consolidate, create, domain, prune, or leak for
+        a merged image left behind), labels and a duration in
+        seconds.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, phase, duration, error=None, **labels):
+        event = {'ts': time.time(), 'phase': phase,
+                 'duration': round(duration, 6), 'error': error}
+        event.update(labels)
+        with self._lock:
+            self.events.append(event)
+        return event
+
+    @contextlib.contextmanager
+    def timer(self, phase, **labels):
+        start = time.time()
+        try:
+            yield
+        except Exception as e:
+            self.add(phase, time.time() - start, error=str(e), **labels)
+            raise
+        self.add(phase, time.time() - start, **labels)
+
+    def write_json(self, path, results):
+        lines = [json.dumps(e, sort_keys=True) for e in self.events]
+        lines.append(json.dumps(
+            {'ts': time.time(), 'phase': 'run',
+             'duration': round(time.time() - self.start, 6),
+             'domains': len(results),
+             'created': len([r for r in results if r['snapshot']]),
+             'deleted': sum(len(r['deleted']) for r in results),
+             'leaked': len([e for e in self.events if e['phase'] == 'leak']),
+             'errors': len([r for r in results if r['error']])},
+            sort_keys=True))
+        data = '\n'.join(lines) + '\n'
+        if path == '-':
+            sys.stdout.write(data)
+        else:
+            with open(path, 'a') as f:
+                f.write(data)
+
+    def write_prometheus(self, path, results):
+        """ Write a textfile collector file. The file is
+            written to a temporary name and renamed so the
+            node exporter never reads a partial file.
+        """
+        phases = {}
+        leaked = {}
+        for e in self.events:
+            if e['phase'] == 'leak':
+                key = (e['uri'], e['domain'])
+                leaked[key] = leaked.get(key, 0) + 1
+                continue
+            if e['phase'] == 'connect':
+                key = (e['uri'], '', e['phase'])
+            else:
+                key = (e['uri'], e['domain'], e['phase'])
+            phases[key] = phases.get(key, 0.0) + e['duration']
+
+        def labels(**kw):
+            return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                                         .replace('"', '\\"'))
+                            for k, v in sorted(kw.items()))
+
+        out = []
+
+        def metric(name, help, samples):
+            out.append('# HELP domsnapshot_%s %s' % (name, help))
+            out.append('# TYPE domsnapshot_%s gauge' % name)
+            for lbl, value in samples:
+                out.append('domsnapshot_%s{%s} %s' % (name, lbl, value))
+
+        metric('phase_duration_seconds',
+               'Time spent per phase in the last run.',
+               [(labels(uri=u, domain=d, phase=p), '%.6f' % v)
+                for (u, d, p), v in sorted(phases.items())])
+        metric('snapshots_created', 'Snapshots created in the last run.',
+               [(labels(uri=r['uri'], domain=r['domain']),
+                 1 if r['snapshot'] else 0) for r in results])
+        metric('snapshots_deleted', 'Snapshots deleted in the last run.',
+               [(labels(uri=r['uri'], domain=r['domain']),
+                 len(r['deleted'])) for r in results])
+        metric('bytes_reclaimed',
+               'Disk allocation freed by pruning, where reported.',
+               [(labels(uri=r['uri'], domain=r['domain']), r['reclaimed'])
+                for r in results if r['reclaimed'] is not None])
+        metric('backing_chain_depth',
+               'Longest disk backing chain after the last run.',
+               [(labels(uri=r['uri'], domain=r['domain']), r['chain'])
+                for r in results if r['chain'] is not None])
+        metric('images_leaked',
+               'Merged images that could not be deleted in the last run.',
+               [(labels(uri=r['uri'], domain=r['domain']),
+                 leaked.get((r['uri'], r['domain']), 0)) for r in results])
+        metric('errors', 'Domains that failed in the last run.',
+               [(labels(uri=r['uri'], domain=r['domain']),
+                 1 if r['error'] else 0) for r in results])
+        metric('run_duration_seconds', 'Duration of the last run.',
+               [('', '%.6f' % (time.time() - self.start))])
+        metric('last_run_timestamp_seconds', 'End time of the last run.',
+               [('', '%d' % time.time())])
+
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(out) + '\n')
+        os.rename(tmp, path)
+
+
+class BlockJobs(object):
+    """ Runs the block commits that merge external snapshots, at
+        most `limit` at once across all disks, domains and
+        hypervisors, each throttled to `bandwidth` MiB/s (0 for
+        unlimited). Progress is logged while waiting.
+    """
+
+    def __init__(self, limit=4, bandwidth=0, timeout=3600, metrics=None):
+        self.bandwidth = bandwidth
+        self.timeout = timeout
+        self.metrics = metrics or Metrics()
+        self._slots = threading.BoundedSemaphore(max(1, limit))
+
+    def run(self, dom, disk, base, top=None, uri=None):
+        """ Commit top down into base. With top None the active
+            image is committed and base pivoted to. Returns the
+            bytes copied.
+        """
+        labels = {'uri': uri, 'domain': dom.name(), 'disk': disk,
+                  'job': 'commit' if top else 'active-commit'}
+        with self._slots:
+            start = time.time()
+            try:
+                if top:
+                    dom.blockCommit(disk, base, top, self.bandwidth, 0)
+                else:
+                    dom.blockCommit(disk, base, None, self.bandwidth,
+                                    libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE)
+                copied = self.wait(dom, disk, pivot=not top)
+            except Exception as e:
+                self.metrics.add('consolidate', time.time() - start,
+                                 error=str(e), **labels)
+                raise
+            self.metrics.add('consolidate', time.time() - start,
+                             bytes=copied, **labels)
+        return copied
+
+    def wait(self, dom, disk, pivot=False):
+        start = last = time.time()
+        copied = end = 0
+        while True:
+            info = dom.blockJobInfo(disk, 0)
+            if not info:
+                # The job is gone once complete, likely after the
+                # last poll saw it
+                return end
+            copied = info.get('cur', 0)
+            end = info.get('end', copied)
+            now = time.time()
+            if now - start > self.timeout:
+                dom.blockJobAbort(disk, 0)
+                raise RuntimeError('Block job on %s timed out after %ds' %
+                                   (disk, self.timeout))
+            if pivot and info.get('end') and copied == info['end']:
+                # An active commit runs until it is pivoted; this
+                # fails while the job is not ready yet
+                try:
+                    dom.blockJobAbort(
+                        disk, libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
+                    return copied
+                except libvirt.libvirtError as e:
+                    LOG.debug("Pivot of %s not ready: %s" % (disk, e))
+            if now - last >= PROGRESS_INTERVAL:
+                LOG.info("Merging %s of %s: %d%% of %d bytes" %
+                         (disk, dom.name(),
+                          100 * copied // max(1, info.get('end', 0)),
+                          info.get('end', 0)))
+                last = now
+            time.sleep(BLOCK_JOB_POLL)
+
+
+def block_jobs(args, metrics=None):
+    return BlockJobs(limit=args.block_jobs, bandwidth=args.bandwidth,
+                     timeout=args.block_job_timeout, metrics=metrics)
+
+
+def xml_string(root):
+    xml = ET.tostring(root)
+    if not isinstance(xml, str):
+        xml = xml.decode('utf-8')
+    return xml
+
+
+def external_snapshot_xml(dom, snap_name, desc, snapshot_dir=None):
+    """ Disk-only snapshot XML with a new qcow2 overlay for every
+        writable file or block disk. Overlays are created next to
+        the active image, or in snapshot_dir.
+    """
+    root = ET.fromstring(dom.XMLDesc(0))
+    snap = ET.Element('domainsnapshot')
+    ET.SubElement(snap, 'name').text = str(snap_name)
+    ET.SubElement(snap, 'description').text = desc
+    disks = ET.SubElement(snap, 'disks')
+    external = 0
+    for disk in root.findall('devices/disk'):
+        target = disk.find('target')
+        if target is None:
+            continue
+        dev = target.get('dev')
+        entry = ET.SubElement(disks, 'disk', name=dev, snapshot='no')
+        source = disk_source(disk)
+        if (disk.get('device', 'disk') != 'disk' or not source or
+                disk.find('readonly') is not None or
+                disk.find('shareable') is not None or
+                disk.get('type') not in ('file', 'block')):
+            continue
+        if disk.get('type') == 'block' and not snapshot_dir:
+            LOG.warning("Not snapshotting block device %s of %s, needs"
+                        " --snapshot-dir" % (dev, dom.name()))
+            continue
+        entry.set('snapshot', 'external')
+        ET.SubElement(entry, 'driver', type='qcow2')
+        ET.SubElement(entry, 'source', file=os.path.join(
+            snapshot_dir or os.path.dirname(source),
+            '%s.%s.%s.qcow2' % (dom.name(), dev, snap_name)))
+        external += 1
+
+    if not external:
+        raise ValueError('No disks of %s can have external snapshots' %
+                         dom.name())
+    return xml_string(snap)
+
+
+def get_snapshot_xml(args, snap_name, dom=None):
+    if args.snapshot_xml is not None:
+        return xml_string(args.snapshot_xml)
+
+    if args.mode == 'external':
+        return external_snapshot_xml(dom, snap_name, args.desc,
+                                     args.snapshot_dir)
+
+    return """<domainsnapshot>
+                <description>%s</description>
+                <name>%s</name>
+              </domainsnapshot>""" % (args.desc, snap_name)
+
+
+def snapshot_domain(conn, qemu_uri, domain, args, metrics=None, jobs=None):
+    """ Run retention and create a new snapshot for one domain.
+        Returns a result dict for the report.
+    """
+    metrics = metrics or Metrics()
+    jobs = jobs or block_jobs(args, metrics)
+    start = time.time()
+    result = _snapshot_domain(conn, qemu_uri, domain, args, metrics, jobs)
+    metrics.add('domain', time.time() - start, error=result['error'],
+                uri=qemu_uri, domain=domain)
+    return result
+
+
+def _snapshot_domain(conn, qemu_uri, domain, args, metrics, jobs):
+    result = {'uri': qemu_uri, 'domain': domain, 'found': False,
+              'snapshot': None, 'deleted': [], 'reclaimed': None,
+              'chain': None, 'error': None}
+    try:
+        with metrics.timer('lookup', uri=qemu_uri, domain=domain):
+            dom = conn.lookupByName(domain)
+    except libvirt.libvirtError:
+        result['error'] = 'Domain not found'
+        LOG.error("Domain %s not found on %s" % (domain, qemu_uri))
+        return result
+    result['found'] = True
+
+    # Delete older snapshots
+    if args.prune == 'before':
+        result['deleted'] = delete_older_snapshots(
+            dom, keep=args.keep, flags=args.del_flags, metrics=metrics,
+            uri=qemu_uri, retries=args.delete_retries, jobs=jobs)
+
+    # Prepare snapshot XML
+    snap_name = args.snapshot_name if args.snapshot_name else int(time.time())
+    flags = args.flags
+    if args.mode == 'external':
+        flags |= EXTERNAL_FLAGS
+
+    LOG.info('Snapshotting domain %s on %s' % (dom.name(), qemu_uri))
+    try:
+        snapshot_xml = get_snapshot_xml(args, snap_name, dom)
+        LOG.debug("Snapshot XML: %s" % snapshot_xml)
+        with metrics.timer('create', uri=qemu_uri, domain=domain,
+                           snapshot=str(snap_name)):
+            snapshot = dom.snapshotCreateXML(snapshot_xml, flags=flags)
+    except Exception as e:
+        result['error'] = str(e)
+        LOG.error("Error snapshotting %s on %s: %s" % (domain, qemu_uri, e))
+        return result
+
+    LOG.debug(snapshot.getXMLDesc())
+    result['snapshot'] = snapshot.getName()
+    LOG.info("Snapshot %s for %s created successfully" %
+             (result['snapshot'], dom.name()))
+    if args.mode == 'external':
+        result['chain'] = chain_depth(dom, args.max_chain)
+    return result
+
+
+def snapshot_host(pool, qemu_uri, args, metrics, jobs=None):
+    """ Snapshot all requested domains on one hypervisor,
+        at most args.host_workers domains at a time.
+    """
+    try:
+        with metrics.timer('connect', uri=qemu_uri):
+            conn = pool.get(qemu_uri)
+    except Exception as e:
+        LOG.error("Failed to open connection to %s: %s" % (qemu_uri, e))
+        return [{'uri': qemu_uri, 'domain': domain, 'found': False,
+                 'snapshot': None, 'deleted': [], 'reclaimed': None,
+                 'chain': None, 'error': 'Connection failed: %s' % e}
+                for domain in args.domains]
+
+    workers = ThreadPool(max(1, min(args.host_workers, len(args.domains))))
+    try:
+        return workers.map(
+            lambda domain: snapshot_domain(conn, qemu_uri, domain, args,
+                                           metrics, jobs),
+            args.domains)
+    finally:
+        workers.close()
+        workers.join()
+
+
+def run_snapshots(args, pool=None, metrics=None):
+    """ Fan out snapshot work over all hypervisors in args.qemu_uris.
+        Returns a flat list of per-domain results, ordered by
+        URI and domain as given on the command line.
+    """
+    metrics = metrics or Metrics()
+    jobs = block_jobs(args, metrics)
+    own_pool = pool is None
+    if own_pool:
+        pool = ConnectionPool()
+
+    hosts = ThreadPool(max(1, min(args.parallel, len(args.qemu_uris))))
+    try:
+        per_host = hosts.map(
+            lambda uri: snapshot_host(pool, uri, args, metrics, jobs),
+            args.qemu_uris)
+        results = [result for results in per_host for result in results]
+        if args.prune == 'after':
+            prune_snapshots(args, results, pool=pool, metrics=metrics,
+                            jobs=jobs)
+    finally:
+        hosts.close()
+        hosts.join()
+        if own_pool:
+            pool.close()
+
+    return results
+
+
+def prune_domain(pool, result, args, metrics, jobs):
+    qemu_uri, domain = result['uri'], result['domain']
+    start = time.time()
+    try:
+        dom = pool.get(qemu_uri).lookupByName(domain)
+        # The snapshot created in this run does not count
+        # towards --keep
+        keep = args.keep + (1 if result['snapshot'] else 0)
+        expired = find_expired_snapshots(dom, keep, metrics=metrics,
+                                         uri=qemu_uri)
+        if expired:
+            before = disk_allocation(dom)
+            # Deleted merged images are not in disk_allocation()
+            removed = []
+            result['deleted'].extend(delete_snapshots(
+                dom, expired, flags=args.del_flags, metrics=metrics,
+                uri=qemu_uri, retries=args.delete_retries, jobs=jobs,
+                removed=removed))
+            after = disk_allocation(dom)
+            if before is not None and after is not None:
+                result['reclaimed'] = max(0, before - after) + sum(removed)
+            elif removed:
+                result['reclaimed'] = sum(removed)
+        if args.mode == 'external':
+            result['chain'] = chain_depth(dom, args.max_chain)
+    except Exception as e:
+        LOG.error("Failed to prune %s on %s: %s" % (domain, qemu_uri, e))
+        result['error'] = result['error'] or 'Prune failed: %s' % e
+    metrics.add('prune', time.time() - start, uri=qemu_uri, domain=domain)
+
+
+def prune_snapshots(args, results, pool=None, metrics=None, jobs=None):
+    """ Delete expired snapshots of all domains in results.
+        Domains are pruned in parallel, at most args.prune_workers
+        deletions run at once; snapshots of a single domain are
+        deleted one by one, disks of external snapshots are merged
+        in parallel. Results are updated in place.
+    """
+    metrics = metrics or Metrics()
+    jobs = jobs or block_jobs(args, metrics)
+    own_pool = pool is None
+    if own_pool:
+        pool = ConnectionPool()
+
+    targets = [r for r in results if r['found']]
+    if not targets:
+        return results
+
+    workers = ThreadPool(max(1, min(args.prune_workers, len(targets))))
+    try:
+        workers.map(lambda r: prune_domain(pool, r, args, metrics, jobs),
+                    targets)
+    finally:
+        workers.close()
+        workers.join()
+        if own_pool:
+            pool.close()
+
+    return results
+
+
+def report(results):
+    failed = [r for r in results if r['error']]
+    for r in results:
+        if r['error']:
+            LOG.error("%s %s: FAILED (%s)" % (r['uri'], r['domain'],
+                                              r['error']))
+        else:
+            LOG.info("%s %s: created %s, deleted %d%s%s" %
+                     (r['uri'], r['domain'], r['snapshot'],
+                      len(r['deleted']),
+                      '' if r['reclaimed'] is None else
+                      ', reclaimed %d bytes' % r['reclaimed'],
+                      '' if r['chain'] is None else
+                      ', backing chain %d' % r['chain']))
+
+    LOG.info("Summary: %d domains, %d created, %d failed, %d deleted" %
+             (len(results), len(results) - len(failed), len(failed),
+              sum(len(r['deleted']) for r in results)))
+    return 1 if failed else 0
+
+
+def background_prune(args, results, metrics):
+    """ Fork a detached process that prunes expired snapshots
+        so the caller can return as soon as snapshots are created.
+        The child opens its own libvirt connections and writes
+        the Prometheus file once pruning is done, including the
+        phases of the caller. Returns True if the child started,
+        False if pruning ran inline.
+    """
+    try:
+        pid = os.fork()
+    except OSError as e:
+        LOG.error("Failed to fork prune process, pruning inline: %s" % e)
+        prune_snapshots(args, results, metrics=metrics)
+        return False
+
+    if pid > 0:
+        LOG.info("Pruning expired snapshots in background process %d" % pid)
+        return True
+
+    rc = 0
+    try:
+        os.setsid()
+        prune_metrics = Metrics()
+        prune_snapshots(args, results, metrics=prune_metrics)
+        rc = report(results)
+        if args.metrics_json:
+            prune_metrics.write_json(args.metrics_json, results)
+        if args.metrics_prom:
+            metrics.events.extend(prune_metrics.events)
+            metrics.write_prometheus(args.metrics_prom, results)
+    except Exception as e:
+        LOG.error("Background prune failed: %s" % e)
+        rc = 1
+    finally:
+        os._exit(rc)
+
+
 def set_logger(debug=False):
     if debug is True:
         LOG.setLevel(logging.DEBUG)
@@ -235,38 +1153,38 @@ def do_snapshot():
     # Set logger config
     set_logger(debug=args.debug)
 
-    # Connect to libvirt
-    conn = connect_libvirt(args.qemu_uri)
     try:
-        dom = conn.lookupByName(args.domain)
-    except libvirt.libvirtError:
-        LOG.error("Domain %s not found?\n" % args.domain)
+        load_libvirt()
+    except ImportError as e:
+        LOG.error("Cannot load the libvirt bindings: %s" % e)
         sys.exit(1)
-    LOG.debug('Connected to libvirt')
 
-    # Delete older snapshots
-    delete_older_snapshots(dom, keep=args.keep, flags=args.del_flags)
+    # Every external snapshot adds an image to the backing chains,
+    # the new snapshot and the base image come on top of --keep
+    if args.mode == 'external' and args.keep > args.max_chain - 2:
+        LOG.warning("Keeping %d snapshots instead of %d so backing chains"
+                    " stay within %d images" %
+                    (args.max_chain - 2, args.keep, args.max_chain))
+        args.keep = args.max_chain - 2
+
+    metrics = Metrics()
+    results = run_snapshots(args, metrics=metrics)
+    forked = False
+    if args.prune == 'background':
+        forked = background_prune(args, results, metrics)
+    rc = report(results)
 
-    # Prepare snapshot XML
-    snap_name = args.snapshot_name if args.snapshot_name else int(time.time())
-    if not args.snapshot_xml:
-        snapshot_xml = """<domainsnapshot>
-                            <description>%s</description>
-                            <name>%s</name>
-                          </domainsnapshot>""" % \
-                       (args.desc, snap_name)
-    LOG.debug("Snapshot XML: %s" % snapshot_xml)
-
-    LOG.info('Snapshotting domain %s' % dom.name())
     try:
-        snapshot = dom.snapshotCreateXML(snapshot_xml, flags=args.flags)
-    except Exception as e:
-        LOG.error("Error snapshotting: %s" % e)
-        sys.exit(1)
+        if args.metrics_json:
+            metrics.write_json(args.metrics_json, results)
+        # Else the prune process writes it when done
+        if args.metrics_prom and not forked:
+            metrics.write_prometheus(args.metrics_prom, results)
+    except (IOError, OSError) as e:
+        LOG.error("Failed to write metrics: %s" % e)
+        rc = 1
 
-    LOG.debug(snapshot.getXMLDesc())
-    LOG.info("Snapshot %s for %s created successfully" %
-             (snap_name, dom.name()))
+    sys.exit(rc)
 
 
 if __name__ == "__main__":
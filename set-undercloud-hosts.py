@@ -1,5 +1,4 @@
 #!/usr/bin/env python
-from novaclient import client
 from subprocess import call
 from os import environ, system, getuid
 import sys
@@ -10,31 +9,39 @@ Script to set hostnames / IP addresses mapping
 in /etc/hosts
 """
 
-try:
-    USERNAME = environ['OS_USERNAME']
-    PASSWORD = environ['OS_PASSWORD']
-    AUTH_URL = environ['OS_AUTH_URL']
-except Exception as e:
-    raise Exception("Missing one or more authentication details: %s" % e)
 
-try:
-    PROJECT_NAME = environ['OS_PROJECT_NAME']
-except Exception as e:
-    PROJECT_NAME = environ['OS_TENANT_NAME']
+def get_credentials():
+    """ (username, password, project name, auth url) of the
+        undercloud from the environment
+    """
+    try:
+        username = environ['OS_USERNAME']
+        password = environ['OS_PASSWORD']
+        auth_url = environ['OS_AUTH_URL']
+    except Exception as e:
+        raise Exception("Missing one or more authentication details: %s" % e)
+
+    try:
+        project_name = environ['OS_PROJECT_NAME']
+    except Exception as e:
+        project_name = environ['OS_TENANT_NAME']
 
-try:
-    OS_CLOUD = environ['OS_CLOUDNAME']
-except Exception as e:
-    raise Exception("Missing OS_CLOUDNAME")
+    try:
+        os_cloud = environ['OS_CLOUDNAME']
+    except Exception as e:
+        raise Exception("Missing OS_CLOUDNAME")
 
-if OS_CLOUD != 'undercloud':
-    raise Exception("You need to load the undercloud authentication details")
+    if os_cloud != 'undercloud':
+        raise Exception("You need to load the undercloud authentication"
+                        " details")
+
+    return username, password, project_name, auth_url
 
 
 def replace_in_file(output):
     if getuid() != 0:
-        print "You need to be root to edit /etc/hosts."
-        print "Try to use 'sudo -E ...'"
+        print("You need to be root to edit /etc/hosts.")
+        print("Try to use 'sudo -E ...'")
         sys.exit(1)
 
     # Remove older entries if any
@@ -43,11 +50,11 @@ def replace_in_file(output):
         call(["perl -i -p0e 's/###setHostsStart###.*?###setHostsEnd###\n//s' /etc/hosts"],
              shell=True)
     except OSError as e:
-        print "OSError > ",e.errno
-        print "OSError > ",e.strerror
-        print "OSError > ",e.filename
+        print("OSError >  %s" % e.errno)
+        print("OSError >  %s" % e.strerror)
+        print("OSError >  %s" % e.filename)
     except:
-        print "Error > ",sys.exc_info()[0]
+        print("Error >  %s" % sys.exc_info()[0])
 
     # Append new
     try:
@@ -68,8 +75,13 @@ def main():
     # Regex to extract short name from
     full_name_regex = r'^overcloud\-(.+?)$'
 
-    nova = client.Client('2', USERNAME, PASSWORD, PROJECT_NAME,
-                         AUTH_URL, connection_pool=True)
+    username, password, project_name, auth_url = get_credentials()
+
+    # Slow to import, load it once the credentials are there
+    from novaclient import client
+
+    nova = client.Client('2', username, password, project_name,
+                         auth_url, connection_pool=True)
 
     prep_list = dict()
 
@@ -102,15 +114,15 @@ def main():
     if '-a' in sys.argv:
         replace_in_file(output)
     else:
-        print "Add the following to your /etc/hosts:\n"
-        print output
+        print("Add the following to your /etc/hosts:\n")
+        print(output)
 
 
 if __name__ == "__main__":
 
     if '-h' in sys.argv:
-        print """Script will output the overcloud hosts and their respective IP addresses.
-Use -a to automatically update /etc/hosts"""
+        print("""Script will output the overcloud hosts and their respective IP addresses.
+Use -a to automatically update /etc/hosts""")
         sys.exit(0)
 
     main()